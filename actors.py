@@ -0,0 +1,190 @@
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from trajectory_queue import TrajectoryQueue
+
+
+class ActorPool:
+    """
+    Actor processes that step their own env pool with a copy of the policy and send the rollouts to the learner.
+
+    The learner's weights are published to a state_dict in shared memory with a
+    version number. Before every rollout an actor reloads them if the version
+    changed, so it acts with a policy that is at most a few updates old: the
+    learner corrects for it (V-trace). A rollout is num_steps steps of all the envs
+    of the actor, filled by a RolloutCollector directly into a slot of a
+    TrajectoryQueue, so the frames are written once in shared memory and never
+    serialized. There are queue_size slots more than actors: when the learner is
+    slower than the actors, the actors wait for a free slot.
+
+    Every trajectory carries the policy version that collected it, the time the
+    actor spent collecting it and the time it waited on the full queue before that,
+    from which stats() computes the utilization of the actors and of the learner.
+
+    Args:
+        agent: Agent of the learner, its weights are the first published ones
+        agent_kwargs: keyword arguments used to build the actors' Agent
+        env_kwargs: keyword arguments of make_env (backend, num_envs, ...)
+        task: task of the env pools
+        env_floder: folder with the custom maps
+        num_actors: number of actor processes
+        num_steps: steps per env in a trajectory
+        queue_size: maximum number of trajectories waiting for the learner, beyond the ones being written
+        seed: seed of the actors, actor i uses seed + i
+        num_threads: torch threads of each actor
+    """
+
+    def __init__(self, agent, agent_kwargs, env_kwargs, task, env_floder, num_actors, num_steps, queue_size=2, seed=0, num_threads=1):
+        ctx = mp.get_context("spawn")
+        self.policy = {name: value.detach().cpu().clone().share_memory_() for name, value in agent.state_dict().items()}
+        self.version = ctx.Value("i", 0)
+        self.stop = ctx.Event()
+
+        obs_shape = agent_kwargs["observation_space_shape"]
+        obs_channels = agent.input_channels(obs_shape[0])
+        steps_envs = (num_steps, env_kwargs["num_envs"])
+        self.trajectories = TrajectoryQueue(num_actors + queue_size, {
+            "obs": (steps_envs + (obs_channels.stop - obs_channels.start,) + tuple(obs_shape[1:]), torch.uint8),
+            "actions": (steps_envs, torch.int64),
+            "logprobs": (steps_envs, torch.float32),
+            "rewards": (steps_envs, torch.float32),
+            "dones": (steps_envs, torch.bool),
+        }, ctx)
+        print(f"Trajectory queue: {self.trajectories.num_slots} slots, {self.trajectories.memory_footprint():.2f} MB")
+        self.processes = [
+            ctx.Process(
+                target=_actor,
+                args=(actor_id, self.trajectories, self.policy, self.version, self.stop, agent_kwargs, env_kwargs,
+                      task, env_floder, num_steps, seed + actor_id, num_threads),
+                daemon=True,
+            )
+            for actor_id in range(num_actors)
+        ]
+        for process in self.processes:
+            process.start()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.start_time = time.perf_counter()
+        self.learner_wait = 0.0
+        self.actor_busy = 0.0
+        self.actor_wait = 0.0
+        self.lags = []
+
+    def publish(self, agent):
+        """Copies the weights of agent to the actors' policy and bumps its version."""
+        with self.version.get_lock():
+            for name, value in agent.state_dict().items():
+                self.policy[name].copy_(value)
+            self.version.value += 1
+
+    def get(self, num_trajectories, device):
+        """
+        Waits for num_trajectories trajectories and returns them concatenated along the envs on device,
+        with the list of their metadata. The slots are released once copied.
+        """
+        slots, metadata = [], []
+        start = time.perf_counter()
+        for _ in range(num_trajectories):
+            slot, info = self.trajectories.get()
+            slots.append(slot)
+            metadata.append(info)
+        self.learner_wait += time.perf_counter() - start
+
+        batch = {
+            name: torch.cat([tensor[slot] for slot in slots], dim=1).to(device)
+            for name, tensor in self.trajectories.slots.items()
+        }
+        for slot in slots:
+            self.trajectories.release(slot)
+
+        for info in metadata:
+            self.actor_busy += info["busy_time"]
+            self.actor_wait += info["wait_time"]
+            self.lags.append(self.version.value - info["version"])
+        return batch, metadata
+
+    def stats(self):
+        """Utilization of actors and learner and mean policy lag since the last call."""
+        elapsed = time.perf_counter() - self.start_time
+        actor_time = self.actor_busy + self.actor_wait
+        stats = {
+            "actor_utilization": self.actor_busy / actor_time if actor_time > 0 else 0.0,
+            "learner_utilization": 1.0 - self.learner_wait / elapsed if elapsed > 0 else 0.0,
+            "policy_lag": sum(self.lags) / len(self.lags) if self.lags else 0.0,
+            "queue_ready": self.trajectories.occupancy()["ready"],
+        }
+        self._reset_stats()
+        return stats
+
+    def close(self):
+        """Stops the actors, the trajectories still in the slots are dropped."""
+        self.stop.set()
+        for process in self.processes:
+            process.join()
+
+
+def _actor(actor_id, trajectories, policy, version, stop, agent_kwargs, env_kwargs, task, env_floder, num_steps, seed, num_threads):
+    from env_backend import make_env, register_custom_maps
+    from main import Agent
+    from rollout import RolloutCollector
+    from rollout_buffer import RolloutBuffer
+    from transfer import HostToDevice
+
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(seed)
+    device = torch.device("cpu")
+    agent = Agent(**agent_kwargs)
+    register_custom_maps(env_kwargs["backend"], env_floder)
+    # Every actor owns a different shard of environments
+    envs = make_env(task=task, seed=42 + actor_id * env_kwargs["num_envs"], **env_kwargs)
+
+    obs_shape = envs.observation_space.shape
+    obs_channels = agent.input_channels(obs_shape[0])
+    stored_obs_shape = (obs_channels.stop - obs_channels.start,) + obs_shape[1:]
+    transfer = HostToDevice(device)
+    buffer = RolloutBuffer(num_steps, env_kwargs["num_envs"], stored_obs_shape, device, transfer=transfer)
+    collector = RolloutCollector(envs, buffer, transfer, obs_channels)
+    collector.reset()
+
+    local_version = -1
+    start = time.perf_counter()
+    slot = _acquire(trajectories, actor_id, stop)
+    wait_time = time.perf_counter() - start
+    while slot is not None:
+        # The collector writes the rollout in place into the slot
+        buffer.use_storage(trajectories.slot(slot))
+        start = time.perf_counter()
+        if version.value != local_version:
+            with version.get_lock():
+                agent.load_state_dict(policy)
+                local_version = version.value
+
+        agent.reset_caches()
+        with agent.merged_lora():
+            num_transitions = collector.collect(agent)
+        trajectories.commit(slot, {
+            "actor_id": actor_id,
+            "version": local_version,
+            "num_transitions": num_transitions,
+            "busy_time": time.perf_counter() - start,
+            "wait_time": wait_time,
+        })
+
+        # Backpressure: the actor waits for a free slot
+        start = time.perf_counter()
+        slot = _acquire(trajectories, actor_id, stop)
+        wait_time = time.perf_counter() - start
+
+    envs.close()
+
+
+def _acquire(trajectories, actor_id, stop):
+    """Waits for a free slot, returns None if the pool is stopped in the meantime."""
+    while not stop.is_set():
+        slot = trajectories.acquire(actor_id, timeout=0.1)
+        if slot is not None:
+            return slot
+    return None
@@ -0,0 +1,178 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+
+import torch
+
+from benchmarking import timed, use_random_weights
+
+
+NETWORK_TYPES = ["cnn", "resnet_s", "resnet_w", "swin_s", "swin_w", "swin_w_hf"]
+FORWARD_TYPES = ["single_frame", "conv_adapter", "multi_frame_avg", "multi_frame_patch_concat"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--network-types", type=str, nargs="+", default=NETWORK_TYPES)
+    parser.add_argument("--forward-types", type=str, nargs="+", default=FORWARD_TYPES)
+    parser.add_argument("--num-envs", type=int, default=32,
+                        help="batch of the rollout forward")
+    parser.add_argument("--minibatch-size", type=int, default=128,
+                        help="batch of the update step")
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--cuda", type=lambda x: x.lower() == "true", default=False)
+    parser.add_argument("--timeout", type=float, default=3600,
+                        help="seconds after which a combination is stopped")
+    parser.add_argument("--output", type=str, default="bench_agents.json")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="JSON file of a previous run, prints the speedups against it")
+    return parser.parse_args()
+
+
+def valid_configs(network_types, forward_types):
+    """Combinations supported by Agent.__init__ and Agent.forward_backbone."""
+    configs = []
+    for network_type in network_types:
+        for forward_type in forward_types:
+            if network_type == "cnn" and forward_type not in ["single_frame", "conv_adapter"]:
+                continue
+            if forward_type == "multi_frame_patch_concat" and network_type != "swin_w_hf":
+                continue
+            for pretrained_adapt in [False, True]:
+                # The HF Swin windows don't tile the 4x concatenated 120x160 frames
+                if forward_type == "multi_frame_patch_concat" and not pretrained_adapt:
+                    continue
+                for use_lora in [False, True] if network_type in ["swin_w", "swin_w_hf"] else [False]:
+                    configs.append({
+                        "network_type": network_type,
+                        "forward_type": forward_type,
+                        "pretrained_adapt": pretrained_adapt,
+                        "use_lora": use_lora,
+                    })
+    return configs
+
+
+def config_name(config):
+    return f"{config['network_type']}/{config['forward_type']}/adapt={config['pretrained_adapt']}/lora={config['use_lora']}"
+
+
+def measure(config, num_envs, minibatch_size, iters, device):
+    """Builds the agent of config and measures parameters, rollout latency, update throughput and peak memory."""
+    use_random_weights()
+    from main import Agent, parse_args as parse_main_args
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    torch.manual_seed(0)
+    agent = Agent((12, 120, 160), 12, args=parse_main_args([]), **config).to(device)
+    optimizer = torch.optim.Adam(agent.parameters(), lr=2.5e-5, eps=1e-5)
+
+    rollout_obs = torch.randint(0, 256, (num_envs, 12, 120, 160), dtype=torch.uint8, device=device)
+    mb_obs = torch.randint(0, 256, (minibatch_size, 12, 120, 160), dtype=torch.uint8, device=device)
+    mb_actions = torch.randint(0, 12, (minibatch_size,), device=device)
+
+    def rollout():
+        with torch.no_grad():
+            agent.get_action_and_value(rollout_obs)
+
+    def update():
+        _, logprob, entropy, value = agent.get_action_and_value(mb_obs, mb_actions)
+        loss = -logprob.mean() - 0.01 * entropy.mean() + 0.5 * (value ** 2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    # As in main.py the adapters are merged once for the whole rollout
+    with agent.merged_lora():
+        rollout_time = timed(rollout, iters, device)
+    update_time = timed(update, iters, device)
+
+    return {
+        **config,
+        "params": sum(p.numel() for p in agent.parameters()),
+        "trainable_params": sum(p.numel() for p in agent.parameters() if p.requires_grad),
+        "rollout_ms": rollout_time * 1e3,
+        "rollout_sps": num_envs / rollout_time,
+        "update_ms": update_time * 1e3,
+        "update_sps": minibatch_size / update_time,
+        # ru_maxrss is in KB on Linux, the peak of the process includes the interpreter and the imports
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "baseline_rss_mb": baseline_rss,
+        "peak_cuda_mb": torch.cuda.max_memory_allocated(device) / 1024**2 if device.type == "cuda" else None,
+    }
+
+
+def _worker(results, config, num_envs, minibatch_size, iters, device):
+    try:
+        results.put(measure(config, num_envs, minibatch_size, iters, torch.device(device)))
+    except Exception as e:
+        results.put({**config, "error": repr(e)})
+
+
+def run_config(config, args, device):
+    """Measures config in a fresh process, so the peak memory of each combination is its own."""
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=_worker, args=(results, config, args.num_envs, args.minibatch_size, args.iters, str(device)))
+    process.start()
+    process.join(args.timeout)
+    if process.is_alive():
+        process.terminate()
+        return {**config, "error": f"timeout after {args.timeout}s"}
+    if results.empty():
+        return {**config, "error": f"process exited with code {process.exitcode}"}
+    return results.get()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+
+    results = []
+    for config in valid_configs(args.network_types, args.forward_types):
+        print(f"Benchmarking {config_name(config)}")
+        results.append(run_config(config, args, device))
+
+    report = {
+        "commit": git_commit(),
+        "torch": torch.__version__,
+        "device": str(device),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+        "num_envs": args.num_envs,
+        "minibatch_size": args.minibatch_size,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = {config_name(r): r for r in json.load(f)["results"] if "error" not in r}
+
+    print(f"\n{'config':>58} {'params':>8} {'rollout':>10} {'update':>12} {'peak rss':>9}" + (f" {'speedup':>15}" if previous else ""))
+    for r in results:
+        name = config_name(r)
+        if "error" in r:
+            print(f"{name:>58} error: {r['error']}")
+            continue
+        line = (f"{name:>58} {r['params'] / 1e6:>7.1f}M {r['rollout_ms']:>8.1f}ms {r['update_sps']:>8.1f}sps"
+                f" {r['peak_rss_mb']:>7.0f}MB")
+        if name in previous:
+            line += f" {previous[name]['rollout_ms'] / r['rollout_ms']:>6.2f}x {r['update_sps'] / previous[name]['update_sps']:>6.2f}x"
+        print(line)
@@ -0,0 +1,78 @@
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from benchmarking import timed, use_random_weights
+from main import Agent, parse_args as parse_main_args, resolve_amp_dtype
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--network-types", type=str, nargs="+", default=["cnn", "resnet_w", "swin_w"])
+    parser.add_argument("--forward-type", type=str, default="single_frame")
+    parser.add_argument("--pretrained-adapt", type=lambda x: x.lower() == "true", default=False)
+    parser.add_argument("--amp-dtype", type=str, default="auto")
+    parser.add_argument("--cuda", type=lambda x: x.lower() == "true", default=False)
+    parser.add_argument("--rollout-batch", type=int, default=32,
+                        help="observations per rollout forward (num_envs)")
+    parser.add_argument("--minibatch-size", type=int, default=128)
+    parser.add_argument("--iters", type=int, default=5)
+    return parser.parse_args()
+
+
+def bench(agent, amp, args, device):
+    """Times a rollout forward and a PPO update step, with the same losses as main.py."""
+    agent.args.amp = amp
+    optimizer = optim.Adam(agent.parameters(), lr=2.5e-5, eps=1e-5)
+    scaler = torch.amp.GradScaler(device.type, enabled=amp and resolve_amp_dtype(device.type, args.amp_dtype) == torch.float16)
+    rollout_obs = torch.randint(0, 256, (args.rollout_batch, 12, 120, 160), dtype=torch.uint8, device=device)
+    mb_obs = torch.randint(0, 256, (args.minibatch_size, 12, 120, 160), dtype=torch.uint8, device=device)
+    mb_actions = torch.randint(0, 12, (args.minibatch_size,), device=device)
+    mb_logprobs = torch.full((args.minibatch_size,), -np.log(12), device=device)
+    mb_advantages = torch.randn(args.minibatch_size, device=device)
+    mb_returns = torch.randn(args.minibatch_size, device=device)
+
+    def rollout():
+        with torch.no_grad():
+            agent.get_action_and_value(rollout_obs)
+
+    def update():
+        _, newlogprob, entropy, newvalue = agent.get_action_and_value(mb_obs, mb_actions)
+        ratio = (newlogprob - mb_logprobs).exp()
+        pg_loss = torch.max(-mb_advantages * ratio, -mb_advantages * torch.clamp(ratio, 0.8, 1.2)).mean()
+        v_loss = 0.5 * ((newvalue.view(-1) - mb_returns) ** 2).mean()
+        loss = pg_loss - 0.01 * entropy.mean() + 0.5 * v_loss
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        nn.utils.clip_grad_norm_(agent.parameters(), 0.5)
+        scaler.step(optimizer)
+        scaler.update()
+
+    return timed(rollout, args.iters, device), timed(update, args.iters, device)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    use_random_weights()
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+    dtype = resolve_amp_dtype(device.type, args.amp_dtype)
+
+    results = []
+    for network_type in args.network_types:
+        torch.manual_seed(0)
+        main_args = parse_main_args(["--amp-dtype", args.amp_dtype])
+        agent = Agent((12, 120, 160), 12, network_type=network_type, pretrained_adapt=args.pretrained_adapt,
+                      forward_type=args.forward_type, args=main_args).to(device)
+        fp32 = bench(agent, False, args, device)
+        amp = bench(agent, True, args, device)
+        results.append((network_type, fp32, amp))
+
+    print(f"\ndevice = {device}, amp dtype = {dtype}")
+    print(f"{'network':>10} {'rollout fp32':>13} {'rollout amp':>12} {'speedup':>8} {'update fp32':>12} {'update amp':>11} {'speedup':>8}")
+    for network_type, (rollout_fp32, update_fp32), (rollout_amp, update_amp) in results:
+        print(f"{network_type:>10} {rollout_fp32 * 1e3:>11.1f}ms {rollout_amp * 1e3:>10.1f}ms {rollout_fp32 / rollout_amp:>8.2f}"
+              f" {update_fp32 * 1e3:>10.1f}ms {update_amp * 1e3:>9.1f}ms {update_fp32 / update_amp:>8.2f}")
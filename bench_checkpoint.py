@@ -0,0 +1,70 @@
+import argparse
+import gc
+import time
+
+import torch
+
+from benchmarking import use_random_weights
+from checkpointing import saved_activation_bytes
+from main import Agent, parse_args as parse_main_args
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", type=str, nargs="+",
+                        default=["resnet_w:single_frame", "swin_w:single_frame", "swin_w_hf:single_frame",
+                                 "swin_w_hf:multi_frame_patch_concat"],
+                        help="network_type:forward_type pairs")
+    parser.add_argument("--pretrained-adapt", type=lambda x: x.lower() == "true", default=True)
+    parser.add_argument("--cuda", type=lambda x: x.lower() == "true", default=False)
+    parser.add_argument("--minibatch-size", type=int, default=16)
+    parser.add_argument("--iters", type=int, default=3)
+    return parser.parse_args()
+
+
+def measure(agent, obs, actions, iters, device):
+    """Returns the activation memory (MB), the peak CUDA memory (MB) and the time (s) of a forward and backward pass."""
+    def step():
+        _, logprob, entropy, value = agent.get_action_and_value(obs, actions)
+        (logprob.sum() + entropy.sum() + value.sum()).backward()
+        agent.zero_grad(set_to_none=True)
+
+    step()  # warmup
+    activations = saved_activation_bytes(lambda: agent.get_action_and_value(obs, actions)) / 1024**2
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) / 1024**2 if device.type == "cuda" else float("nan")
+    return activations, peak, (time.perf_counter() - start) / iters
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    use_random_weights()
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+    obs = torch.randint(0, 256, (args.minibatch_size, 12, 120, 160), dtype=torch.uint8, device=device)
+    actions = torch.zeros(args.minibatch_size, dtype=torch.long, device=device)
+
+    results = []
+    for config in args.configs:
+        network_type, forward_type = config.split(":")
+        torch.manual_seed(0)
+        agent = Agent((12, 120, 160), 12, network_type=network_type, pretrained_adapt=args.pretrained_adapt,
+                      forward_type=forward_type, args=parse_main_args([])).to(device)
+        baseline = measure(agent, obs, actions, args.iters, device)
+        agent.enable_grad_checkpoint()
+        checkpointed = measure(agent, obs, actions, args.iters, device)
+        results.append((config, baseline, checkpointed))
+        del agent
+        gc.collect()
+
+    print(f"\ndevice = {device}, minibatch = {args.minibatch_size}, activations = tensors saved for backward")
+    print(f"{'config':>36} {'activations':>18} {'peak (cuda)':>20} {'time':>20} {'slowdown':>8}")
+    for config, (act, peak, t), (act_ckpt, peak_ckpt, t_ckpt) in results:
+        print(f"{config:>36} {act:>7.0f} -> {act_ckpt:>5.0f}MB {peak:>8.0f} -> {peak_ckpt:>6.0f}MB"
+              f" {t * 1e3:>7.0f} -> {t_ckpt * 1e3:>6.0f}ms {t_ckpt / t:>8.2f}")
@@ -0,0 +1,88 @@
+import argparse
+
+import torch
+
+from benchmarking import timed
+from gae import compute_gae, compute_returns
+
+
+def loop_gae(rewards, values, dones, next_value, gamma, gae_lambda):
+    """The original advantage loop of main.py, used as reference."""
+    num_steps = rewards.shape[0]
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = 0
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            nextnonterminal = ~ dones[-1]
+            nextvalues = next_value
+        else:
+            nextnonterminal = ~ dones[t + 1]
+            nextvalues = values[t + 1]
+        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+        advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+    return advantages, advantages + values
+
+
+def loop_returns(rewards, values, dones, next_value, gamma):
+    """The original --gae False loop of main.py, used as reference."""
+    num_steps = rewards.shape[0]
+    returns = torch.zeros_like(rewards)
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            nextnonterminal = ~ dones[-1]
+            next_return = next_value
+        else:
+            nextnonterminal = ~ dones[t + 1]
+            next_return = returns[t + 1]
+        returns[t] = rewards[t] + gamma * nextnonterminal * next_return
+    return returns - values, returns
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-steps", type=int, nargs="+", default=[64, 128, 256, 512])
+    parser.add_argument("--num-envs", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--gamma", type=float, default=0.99)
+    parser.add_argument("--gae-lambda", type=float, default=0.95)
+    parser.add_argument("--done-prob", type=float, default=0.01,
+                        help="probability of an episode ending at each step")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+    device = torch.device("cpu")
+
+    print(f"{'num_steps':>9} {'num_envs':>8} | {'fn':>7} | {'loop ms':>8} {'script ms':>9} {'chunked ms':>10} | {'max err':>8}")
+    for num_steps in args.num_steps:
+        for num_envs in args.num_envs:
+            rewards = torch.randn(num_steps, num_envs)
+            values = torch.randn(num_steps, num_envs)
+            dones = torch.rand(num_steps, num_envs) < args.done_prob
+            next_value = torch.randn(1, num_envs)
+
+            cases = {
+                "gae": (
+                    lambda: loop_gae(rewards, values, dones, next_value, args.gamma, args.gae_lambda),
+                    lambda method: compute_gae(rewards, values, dones, next_value, args.gamma, args.gae_lambda, method=method),
+                ),
+                "returns": (
+                    lambda: loop_returns(rewards, values, dones, next_value, args.gamma),
+                    lambda method: compute_returns(rewards, values, dones, next_value, args.gamma, method=method),
+                ),
+            }
+            for name, (reference, vectorized) in cases.items():
+                expected = reference()
+                max_err = 0.0
+                for method in ["script", "chunked"]:
+                    for out, exp in zip(vectorized(method), expected):
+                        max_err = max(max_err, (out - exp).abs().max().item())
+                assert max_err < args.atol, f"{name} mismatch: {max_err}"
+
+                loop_ms = timed(reference, args.repeats, device) * 1e3
+                script_ms = timed(lambda: vectorized("script"), args.repeats, device) * 1e3
+                chunked_ms = timed(lambda: vectorized("chunked"), args.repeats, device) * 1e3
+                print(f"{num_steps:>9} {num_envs:>8} | {name:>7} | {loop_ms:>8.3f} {script_ms:>9.3f} {chunked_ms:>10.3f} | {max_err:>8.1e}")
@@ -0,0 +1,65 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from env_backend import SyntheticVizDoomEnv
+from main import Agent, parse_args as parse_main_args
+from rollout import RolloutCollector
+from rollout_buffer import RolloutBuffer
+from transfer import HostToDevice
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--network-type", type=str, default="cnn")
+    parser.add_argument("--forward-type", type=str, default="single_frame")
+    parser.add_argument("--pretrained-adapt", type=lambda x: x.lower() == "true", default=False)
+    parser.add_argument("--num-envs", type=int, default=32)
+    parser.add_argument("--num-steps", type=int, default=32)
+    parser.add_argument("--async-batches", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--step-time", type=float, default=2e-3,
+                        help="simulated seconds per env step")
+    parser.add_argument("--step-time-spread", type=float, default=0.0,
+                        help="the step time grows linearly over the envs up to (1 + spread) * step-time, envs out of step")
+    parser.add_argument("--rollouts", type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(0)
+    device = torch.device("cpu")
+    obs_shape = (12, 120, 160)  # SyntheticVizDoomEnv observations
+
+    agent = Agent(obs_shape, 12, network_type=args.network_type, pretrained_adapt=args.pretrained_adapt,
+                  forward_type=args.forward_type, args=parse_main_args([])).to(device)
+    obs_channels = agent.input_channels(obs_shape[0])
+    stored_obs_shape = (obs_channels.stop - obs_channels.start,) + obs_shape[1:]
+
+    results = []
+    for async_batches in args.async_batches:
+        step_time = args.step_time * (1 + args.step_time_spread * np.linspace(0, 1, args.num_envs))
+        envs = SyntheticVizDoomEnv("Default-Conf-v1", args.num_envs, args.num_envs // async_batches,
+                                   step_time=step_time, num_threads=min(args.num_envs, os.cpu_count()))
+        transfer = HostToDevice(device)
+        buffer = RolloutBuffer(args.num_steps, args.num_envs, stored_obs_shape, device,
+                               num_frames=stored_obs_shape[0] // 3, transfer=transfer)
+        collector = RolloutCollector(envs, buffer, transfer, obs_channels)
+        collector.reset()
+        collector.collect(agent)  # warmup
+
+        num_transitions = 0
+        start = time.perf_counter()
+        for _ in range(args.rollouts):
+            num_transitions += collector.collect(agent)
+        sps = num_transitions / (time.perf_counter() - start)
+        envs.close()
+        results.append((async_batches, envs.batch_size, sps))
+
+    print(f"{'mode':>12} {'batch_size':>10} {'SPS':>10} {'speedup':>8}")
+    for async_batches, batch_size, sps in results:
+        mode = "sync" if async_batches == 1 else f"async x{async_batches}"
+        print(f"{mode:>12} {batch_size:>10} {sps:>10.1f} {sps / results[0][2]:>8.2f}")
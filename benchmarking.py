@@ -0,0 +1,31 @@
+import time
+
+import torch
+
+
+def timed(fn, iters, device):
+    """Mean wall time (s) of fn() over iters calls, after a warmup call."""
+    fn()  # warmup
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+
+def use_random_weights(patch=setattr):
+    """
+    Builds the pretrained backbones (resnet_w, swin_w, swin_w_hf) with random weights, nothing is downloaded.
+    patch(obj, name, value) replaces the constructors, e.g. monkeypatch.setattr to undo it after a test.
+    """
+    import torchvision.models as tv_models
+    from transformers import SwinConfig, SwinForImageClassification
+
+    resnet18, swin_t = tv_models.resnet18, tv_models.swin_transformer.swin_t
+    patch(tv_models, "resnet18", lambda weights=None, **kwargs: resnet18(weights=None, **kwargs))
+    patch(tv_models.swin_transformer, "swin_t", lambda weights=None, **kwargs: swin_t(weights=None, **kwargs))
+    # SwinConfig() is the configuration of microsoft/swin-tiny-patch4-window7-224
+    patch(SwinForImageClassification, "from_pretrained", classmethod(lambda cls, name, **kwargs: cls(SwinConfig())))
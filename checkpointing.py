@@ -0,0 +1,72 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+@contextlib.contextmanager
+def _keep_batch_norm_stats(module):
+    # The recomputation runs the stage in train mode again, its BatchNorm updates are undone
+    batch_norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    stats = [[buffer.clone() for buffer in m.buffers()] for m in batch_norms]
+    try:
+        yield
+    finally:
+        for m, saved in zip(batch_norms, stats):
+            for buffer, value in zip(m.buffers(), saved):
+                buffer.copy_(value)
+
+
+class CheckpointedSequential(nn.Sequential):
+    """
+    nn.Sequential whose activations are recomputed in the backward pass instead of being stored.
+
+    Only the input of the stage is kept for backward. Checkpointing is skipped in eval
+    mode and under no_grad (rollout and evaluation), where nothing is stored anyway.
+    BatchNorm running stats are updated once, by the forward pass.
+    """
+
+    def forward(self, x):
+        if self.training and torch.is_grad_enabled():
+            context_fn = lambda: (contextlib.nullcontext(), _keep_batch_norm_stats(self))
+            return checkpoint(super().forward, x, use_reentrant=False, context_fn=context_fn)
+        return super().forward(x)
+
+
+def checkpoint_stages(stages):
+    """Turns the nn.Sequential stages into CheckpointedSequential, in place so the state_dict keys don't change."""
+    for stage in stages:
+        if type(stage) is nn.Sequential:
+            stage.__class__ = CheckpointedSequential
+
+
+def saved_activation_bytes(fn):
+    """
+    Runs fn() and returns the bytes of the tensors autograd stores for backward, counting each storage once.
+
+    The non-reentrant checkpoint keeps the input of a CheckpointedSequential with its own
+    saved tensor hooks, which bypass the ones installed here, so these inputs are counted
+    by a forward pre-hook instead.
+    """
+    storages = {}
+
+    def add(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+
+    def pack(tensor):
+        add(tensor)
+        return tensor
+
+    def add_checkpoint_input(module, args):
+        if isinstance(module, CheckpointedSequential) and module.training and torch.is_grad_enabled():
+            add(args[0])
+
+    handle = nn.modules.module.register_module_forward_pre_hook(add_checkpoint_input)
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            fn()
+    finally:
+        handle.remove()
+    return sum(storages.values())
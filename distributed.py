@@ -0,0 +1,79 @@
+import datetime
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend="gloo"):
+    """
+    Joins the process group when the script is launched by torchrun, returns (rank, world_size, local_rank).
+
+    Without torchrun (WORLD_SIZE unset or 1) nothing is initialized and the run is a single process.
+    The timeout is long because the other ranks wait in the next all-reduce while rank 0 evaluates.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1, 0
+    dist.init_process_group(backend, timeout=datetime.timedelta(hours=2))
+    return dist.get_rank(), world_size, int(os.environ.get("LOCAL_RANK", 0))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def broadcast_state(model, src=0):
+    """Copies the parameters and buffers of rank src to every rank."""
+    if not is_distributed():
+        return
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src)
+
+
+def broadcast_buffers(model, src=0):
+    """Copies the buffers (BatchNorm running stats) of rank src to every rank, as DDP does before each forward."""
+    if not is_distributed():
+        return
+    for buffer in model.buffers():
+        dist.broadcast(buffer.data, src)
+
+
+def all_reduce_gradients(model):
+    """
+    Averages the gradients of the trainable parameters over the ranks, in one flat all-reduce.
+    A parameter without a gradient on this rank contributes zeros, so every rank sends the same layout.
+    """
+    if not is_distributed():
+        return
+    params = [p for p in model.parameters() if p.requires_grad]
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for p in params:
+        numel = p.numel()
+        p.grad = flat[offset:offset + numel].view_as(p).clone()
+        offset += numel
+
+
+def global_mean_std(x):
+    """Mean and (unbiased) std of x over all the ranks, as x.mean() and x.std() of the concatenated shards."""
+    if not is_distributed():
+        return x.mean(), x.std()
+    stats = torch.stack([x.sum(), (x * x).sum(), torch.tensor(float(x.numel()), device=x.device)]).double()
+    dist.all_reduce(stats)
+    total, total_sq, count = stats
+    mean = total / count
+    var = (total_sq - count * mean * mean) / (count - 1)
+    return mean.to(x.dtype), var.clamp(min=0).sqrt().to(x.dtype)
+
+
+def global_mean(value):
+    """Average of a scalar tensor over the ranks, used for decisions every rank must take together."""
+    if not is_distributed():
+        return value
+    value = value.detach().clone().double()
+    dist.all_reduce(value)
+    return (value / dist.get_world_size()).float()
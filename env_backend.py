@@ -0,0 +1,250 @@
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def register_custom_maps(backend, env_floder):
+    """Registers the scenarios of env_floder in envpool, nothing to do for the synthetic backend."""
+    if backend == "envpool":
+        from envpool.vizdoom.registration import register_custom_folder
+
+        register_custom_folder(env_floder)
+
+
+def make_env(backend, task, num_envs, batch_size=None, seed=42, **kwargs):
+    """
+    Creates a vectorized environment with the envpool gymnasium API.
+
+    Args:
+        backend: "envpool" for the VizDoom scenarios, "synthetic" for SyntheticVizDoomEnv
+        task: envpool task id, for the synthetic backend it only seeds the frames
+        num_envs: number of parallel environments
+        batch_size: number of envs returned by recv(), num_envs if None
+        seed: seed of the environments
+        **kwargs: backend specific options (VizDoom options for envpool, step_time for synthetic)
+    """
+    batch_size = num_envs if batch_size is None else batch_size
+    match backend:
+        case "envpool":
+            import envpool
+
+            return envpool.make(
+                task,
+                env_type="gymnasium",
+                num_envs=num_envs,
+                batch_size=batch_size,
+                seed=seed,
+                use_combined_action=True,
+                **kwargs,
+            )
+        case "synthetic":
+            synthetic_kwargs = {k: v for k, v in kwargs.items() if k in ["max_episode_steps", "step_time", "num_threads"]}
+            return SyntheticVizDoomEnv(task, num_envs, batch_size, seed=seed, **synthetic_kwargs)
+        case default:
+            raise ValueError(f"Unknown env backend: {backend}")
+
+
+class Box:
+    def __init__(self, low, high, shape, dtype):
+        self.low = low
+        self.high = high
+        self.shape = tuple(shape)
+        self.dtype = dtype
+
+
+class Discrete:
+    def __init__(self, n):
+        self.n = n
+        self.shape = ()
+        self.dtype = np.int64
+
+
+class SyntheticVizDoomEnv:
+    """
+    Deterministic stand-in for an envpool VizDoom pool, used to profile the training loop without the game.
+
+    Matches run_and_gun/conf.cfg: 160x120 RGB frames (CRCGCB), a stack of 4 frames
+    (12x120x160 uint8 observations), the combined action space of TURN_LEFT,
+    TURN_RIGHT, MOVE_FORWARD and ATTACK (12 actions) and KILLCOUNT_TOTAL in info.
+    Every env has its own random generator, so the content of an episode only
+    depends on the seed, the env id and the actions, not on the order of recv().
+
+    Args:
+        task: name of the scenario, mixed into the seed
+        num_envs: number of parallel environments
+        batch_size: number of envs returned by recv()
+        seed: seed of the environments
+        max_episode_steps: steps after which an episode is truncated
+        step_time: simulated seconds per env step, 0 to measure the learner alone, or one value per env
+        num_threads: worker threads stepping the envs, 0 steps them inline in send()
+    """
+
+    num_frames = 4
+    frame_shape = (3, 120, 160)
+    num_actions = 12
+    bank_size = 64
+
+    def __init__(self, task, num_envs, batch_size=None, seed=42, max_episode_steps=1250, step_time=0.0, num_threads=0):
+        self.task = task
+        self.num_envs = num_envs
+        self.batch_size = num_envs if batch_size is None else batch_size
+        self.max_episode_steps = max_episode_steps
+        self.step_time = np.broadcast_to(np.asarray(step_time, dtype=np.float64), (num_envs,))
+
+        task_seed = sum(ord(c) for c in task)
+        self.observation_space = Box(0, 255, (self.num_frames * self.frame_shape[0],) + self.frame_shape[1:], np.uint8)
+        self.action_space = Discrete(self.num_actions)
+
+        # Frames are taken from a fixed bank, so generating an observation costs a copy
+        bank_rng = np.random.default_rng([seed, task_seed])
+        self.bank = bank_rng.integers(0, 256, (self.bank_size,) + self.frame_shape, dtype=np.uint8)
+
+        self.rngs = [np.random.default_rng([seed, task_seed, env_id]) for env_id in range(num_envs)]
+        self.stacks = np.zeros((num_envs,) + self.observation_space.shape, dtype=np.uint8)
+        self.elapsed_step = np.zeros(num_envs, dtype=np.int32)
+        self.kills = np.zeros(num_envs, dtype=np.float64)
+        self.reward = np.zeros(num_envs, dtype=np.float32)
+        self.term = np.zeros(num_envs, dtype=bool)
+        self.trunc = np.zeros(num_envs, dtype=bool)
+        self.needs_reset = np.ones(num_envs, dtype=bool)
+
+        self.executor = ThreadPoolExecutor(num_threads) if num_threads > 0 else None
+        self.ready = queue.Queue()
+
+    def _frame(self, env_id):
+        return self.bank[self.rngs[env_id].integers(self.bank_size)]
+
+    def _reset_env(self, env_id):
+        self.stacks[env_id] = np.tile(self._frame(env_id), (self.num_frames, 1, 1))
+        self.elapsed_step[env_id] = 0
+        self.kills[env_id] = 0
+        self.reward[env_id] = 0
+        self.term[env_id] = False
+        self.trunc[env_id] = False
+        self.needs_reset[env_id] = False
+
+    def _step_env(self, env_id, action):
+        if self.step_time[env_id] > 0:
+            time.sleep(self.step_time[env_id])
+        if self.needs_reset[env_id]:
+            self._reset_env(env_id)
+            return
+        rng = self.rngs[env_id]
+        c = self.frame_shape[0]
+        self.stacks[env_id, :-c] = self.stacks[env_id, c:]
+        self.stacks[env_id, -c:] = self._frame(env_id)
+        self.elapsed_step[env_id] += 1
+
+        # ATTACK is the last button of the combined action, a kill needs an attack
+        kill = (action % 2 == 1) and rng.random() < 0.05
+        self.kills[env_id] += kill
+        self.reward[env_id] = float(kill) - 0.001
+        self.term[env_id] = rng.random() < 1e-3
+        self.trunc[env_id] = self.elapsed_step[env_id] >= self.max_episode_steps
+        self.needs_reset[env_id] = self.term[env_id] or self.trunc[env_id]
+
+    def _run(self, env_id, action):
+        self._step_env(env_id, action)
+        self.ready.put(env_id)
+
+    def _outputs(self, env_id):
+        info = {
+            "env_id": env_id,
+            "elapsed_step": self.elapsed_step[env_id].copy(),
+            "KILLCOUNT_TOTAL": self.kills[env_id].copy(),
+        }
+        return self.stacks[env_id].copy(), self.reward[env_id].copy(), self.term[env_id].copy(), self.trunc[env_id].copy(), info
+
+    # Async API used by the training loop
+    def async_reset(self):
+        self.needs_reset[:] = True
+        self.send(np.zeros(self.num_envs, dtype=np.int64), np.arange(self.num_envs))
+
+    def send(self, action, env_id=None):
+        env_id = np.arange(self.num_envs) if env_id is None else env_id
+        for i, a in zip(env_id, action):
+            if self.executor is not None:
+                self.executor.submit(self._run, int(i), int(a))
+            else:
+                self._run(int(i), int(a))
+
+    def recv(self):
+        env_id = np.array([self.ready.get() for _ in range(self.batch_size)])
+        return self._outputs(env_id)
+
+    # Sync API used by test()
+    def reset(self):
+        env_id = np.arange(self.num_envs)
+        for i in env_id:
+            self._reset_env(i)
+        obs, _, _, _, info = self._outputs(env_id)
+        return obs, info
+
+    def step(self, action, env_id=None):
+        env_id = np.arange(self.num_envs) if env_id is None else np.asarray(env_id)
+        for i, a in zip(env_id, action):
+            self._step_env(int(i), int(a))
+        return self._outputs(env_id)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+class MultiTaskEnv:
+    """
+    Env pools of several tasks stepped together behind the async API of a single pool.
+
+    The envs of pool i have the ids offsets[i] to offsets[i + 1] - 1 and task_ids
+    maps every env to its pool. recv() receives one batch from every pool and returns
+    them concatenated, so the policy runs once on the envs of all the tasks; send()
+    routes the actions back to the pool of each env.
+
+    Args:
+        pools: env pools with the same observation and action spaces, one per task
+        num_envs: number of envs of each pool
+    """
+
+    def __init__(self, pools, num_envs):
+        self.pools = pools
+        self.offsets = np.concatenate([[0], np.cumsum(num_envs)])
+        self.num_envs = int(self.offsets[-1])
+        self.task_ids = np.repeat(np.arange(len(pools)), num_envs)
+        self.observation_space = pools[0].observation_space
+        self.action_space = pools[0].action_space
+
+    def async_reset(self):
+        for pool in self.pools:
+            pool.async_reset()
+
+    def send(self, action, env_id):
+        env_id = np.asarray(env_id)
+        action = np.asarray(action)
+        task_ids = self.task_ids[env_id]
+        for i, pool in enumerate(self.pools):
+            mask = task_ids == i
+            if mask.any():
+                pool.send(action[mask], env_id[mask] - self.offsets[i])
+
+    def recv(self):
+        outputs = [pool.recv() for pool in self.pools]
+        next_obs, reward, term, trunc = (np.concatenate([out[k] for out in outputs]) for k in range(4))
+        infos = []
+        for i, out in enumerate(outputs):
+            info = dict(out[4])
+            info["env_id"] = np.asarray(info["env_id"]) + self.offsets[i]
+            infos.append(info)
+        return next_obs, reward, term, trunc, _concatenate_infos(infos)
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+
+def _concatenate_infos(infos):
+    # envpool nests some infos (players) in dicts
+    if isinstance(infos[0], dict):
+        return {key: _concatenate_infos([info[key] for info in infos]) for key in infos[0]}
+    return np.concatenate([np.atleast_1d(info) for info in infos])
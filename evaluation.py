@@ -0,0 +1,205 @@
+import os
+import queue
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def evaluate(model, test_envs, device, max_steps=1250, record_frames=False):
+    """
+    Evaluates the model on every test env pool concurrently.
+
+    At every step the observations of all the pools that are still running are
+    passed to the model in one batched forward. The actions are then sent to all
+    the pools before any result is received (async send/recv API), so the pools
+    simulate their step at the same time. A pool stops after as many
+    finished episodes as it has envs, or after max_steps steps. The episode
+    accumulators are preallocated arrays over all the envs of all the pools.
+
+    Args:
+        model: Agent to evaluate
+        test_envs: list of env pools with the reset/send/recv API, one per task
+        device: device of the model
+        max_steps: maximum number of steps per pool
+        record_frames: if True, the last frame of the first episode of env 0 of each pool is recorded
+
+    Returns:
+        list with a dict per pool: mean_return, mean_len, kills, success, frames
+    """
+    model.eval()
+    num_tasks = len(test_envs)
+
+    obs = [test_env.reset()[0] for test_env in test_envs]
+    obs_channels = model.input_channels(obs[0].shape[1])
+    sizes = np.array([len(o) for o in obs])
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    task_of = np.repeat(np.arange(num_tasks), sizes)
+    total_envs = offsets[-1]
+
+    episode_rewards = np.zeros(total_envs)
+    episode_len = np.zeros(total_envs)
+    step_reward = np.zeros(total_envs)
+    step_done = np.zeros(total_envs, dtype=bool)
+    step_kills = np.zeros(total_envs)
+    running = np.zeros(total_envs, dtype=bool)
+
+    sum_reward = np.zeros(num_tasks)
+    sum_len = np.zeros(num_tasks)
+    kills = np.zeros(num_tasks)
+    count_done = np.zeros(num_tasks, dtype=np.int64)
+    active = np.ones(num_tasks, dtype=bool)
+
+    frames = [[] for _ in range(num_tasks)]
+    ep0_end = np.zeros(num_tasks, dtype=bool)
+
+    with torch.no_grad():
+        for _ in range(max_steps):
+            tasks = np.flatnonzero(active)
+            batch = np.concatenate([obs[i][:, obs_channels] for i in tasks])
+            action, _, _, _ = model.get_action_and_value(torch.from_numpy(batch).to(device))
+            action = action.cpu().numpy()
+
+            step_reward[:] = 0
+            step_done[:] = False
+            step_kills[:] = 0
+            start = 0
+            for i in tasks:
+                test_envs[i].send(action[start:start + sizes[i]], np.arange(sizes[i]))
+                start += sizes[i]
+            for i in tasks:
+                next_obs, reward, terminated, truncated, info = test_envs[i].recv()
+                # The envs of a pool may come back in any order
+                order = np.argsort(info["env_id"])
+                next_obs, reward, terminated, truncated = next_obs[order], reward[order], terminated[order], truncated[order]
+                info = {"KILLCOUNT_TOTAL": np.asarray(info["KILLCOUNT_TOTAL"])[order]}
+                envs = slice(offsets[i], offsets[i + 1])
+                step_reward[envs] = reward
+                step_done[envs] = terminated | truncated
+                step_kills[envs] = info["KILLCOUNT_TOTAL"]
+                obs[i] = next_obs
+
+                if record_frames and not ep0_end[i]:
+                    # Copy, a view would keep the whole batch of observations alive
+                    frames[i].append(next_obs[0][-3:].copy())
+                ep0_end[i] |= step_done[offsets[i]]
+
+            running[:] = active[task_of]
+            episode_rewards += step_reward
+            episode_len += running
+
+            count_done += np.bincount(task_of[step_done], minlength=num_tasks)
+            sum_reward += np.bincount(task_of, weights=episode_rewards * step_done, minlength=num_tasks)
+            sum_len += np.bincount(task_of, weights=episode_len * step_done, minlength=num_tasks)
+            kills += np.bincount(task_of, weights=step_kills * step_done, minlength=num_tasks)
+            episode_rewards[step_done] = 0
+            episode_len[step_done] = 0
+
+            active &= count_done < sizes
+            if not active.any():
+                break
+    model.train()
+
+    results = []
+    for i in range(num_tasks):
+        episodes = count_done[i] if count_done[i] > 0 else np.nan
+        mean_kills = kills[i] / episodes
+        results.append({
+            "mean_return": sum_reward[i] / episodes,
+            "mean_len": sum_len[i] / episodes,
+            "kills": mean_kills,
+            "success": (mean_kills - 3.5) / 26.5,
+            "frames": frames[i],
+        })
+    return results
+
+
+class EvalWorker:
+    """
+    Runs evaluate() in a separate process, against its own test env pools.
+
+    submit() snapshots the agent weights on CPU and hands them to the worker,
+    training continues while the evaluation runs. poll() returns the finished
+    evaluations together with the global_step they were submitted at. If the
+    worker already has a queued job, the new one is skipped unless block is True.
+
+    Args:
+        agent_kwargs: keyword arguments used to build the worker's Agent
+        env_kwargs: keyword arguments of make_env for the test pools (backend, num_envs, ...)
+        tasks: tasks of the test pools
+        env_floder: folder with the custom maps
+        device: device used by the worker
+        max_steps: maximum number of steps per pool
+    """
+
+    def __init__(self, agent_kwargs, env_kwargs, tasks, env_floder, device="cpu", max_steps=1250):
+        ctx = mp.get_context("spawn")
+        self.jobs = ctx.Queue(maxsize=1)
+        self.results = ctx.Queue()
+        self.pending = 0
+        self.process = ctx.Process(
+            target=_eval_worker,
+            args=(self.jobs, self.results, agent_kwargs, env_kwargs, tasks, env_floder, str(device), max_steps),
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, agent, global_step, save_gif=False, trackmatrix=False, task=None, block=False):
+        state_dict = {name: value.detach().cpu().clone() for name, value in agent.state_dict().items()}
+        job = {"global_step": global_step, "save_gif": save_gif, "trackmatrix": trackmatrix, "task": task, "state_dict": state_dict}
+        try:
+            self.jobs.put(job, block=block)
+        except queue.Full:
+            print(f"Evaluation worker busy, skipping evaluation at global_step={global_step}")
+            return False
+        self.pending += 1
+        return True
+
+    def poll(self, block=False):
+        """Returns the finished evaluations, waits for all of them if block is True."""
+        finished = []
+        while self.pending > 0:
+            try:
+                finished.append(self.results.get(block=block))
+            except queue.Empty:
+                break
+            self.pending -= 1
+        return finished
+
+    def close(self):
+        """Waits for the pending evaluations, stops the worker and returns their results."""
+        finished = self.poll(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        return finished
+
+
+def _eval_worker(jobs, results, agent_kwargs, env_kwargs, tasks, env_floder, device, max_steps):
+    from env_backend import make_env, register_custom_maps
+    from main import Agent, save_frames_as_gif
+
+    device = torch.device(device)
+    agent = Agent(**agent_kwargs).to(device)
+    register_custom_maps(env_kwargs["backend"], env_floder)
+    test_envs = [make_env(task=task, **env_kwargs) for task in tasks]
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        agent.load_state_dict(job.pop("state_dict"))
+        start = time.time()
+        with agent.merged_lora():
+            job_results = evaluate(agent, test_envs, device, max_steps=max_steps, record_frames=job["save_gif"])
+
+        # The gifs are written here, so the frames don't go through the queue
+        for task, result in zip(tasks, job_results):
+            if job["save_gif"]:
+                os.makedirs("gifs", exist_ok=True)
+                save_frames_as_gif(frames=result["frames"], filename=f"gifs/{task}_{job['global_step']}.gif")
+            result["frames"] = []
+        results.put({**job, "results": job_results, "time": time.time() - start})
+
+    for test_env in test_envs:
+        test_env.close()
@@ -0,0 +1,60 @@
+import torch
+
+
+class SlotCache:
+    """
+    Cache of tensors computed from the observations of a rollout, keyed by rollout slot.
+
+    A slot is the index of an observation in the flattened (num_steps * num_envs)
+    rollout, the same index used for the minibatches of the PPO update. Values are
+    computed once (during the rollout) and then served to every update epoch, reset()
+    invalidates them when the next rollout starts. The storage is allocated at the
+    first store, with the shape and dtype of the computed values.
+
+    Args:
+        num_slots: number of observations in a rollout
+        device: device of the storage
+        flops_per_slot: FLOPs needed to compute the value of one slot, used for the report
+    """
+
+    def __init__(self, num_slots, device, flops_per_slot=0):
+        self.num_slots = num_slots
+        self.device = device
+        self.flops_per_slot = flops_per_slot
+        self.storage = None
+        self.valid = torch.zeros(num_slots, dtype=torch.bool, device=device)
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        """Invalidates all the slots, called at the start of every rollout."""
+        self.valid.zero_()
+
+    def lookup(self, slots, compute):
+        """Returns the cached values of slots, compute() is called (and its result stored) if any is missing."""
+        slots = torch.as_tensor(slots, device=self.device)
+        if bool(self.valid[slots].all()):
+            self.hits += len(slots)
+            return self.storage[slots]
+
+        values = compute()
+        if self.storage is None:
+            self.storage = torch.empty((self.num_slots,) + values.shape[1:], dtype=values.dtype, device=self.device)
+            print(f"Slot cache: Totale = {self.storage.element_size() * self.storage.nelement() / 1024**2:.2f} MB")
+        self.storage[slots] = values.detach()
+        self.valid[slots] = True
+        self.misses += len(slots)
+        return values
+
+    def __getstate__(self):
+        # The cached values belong to the current rollout, they are not saved with the model
+        state = self.__dict__.copy()
+        state["storage"] = None
+        state["valid"] = torch.zeros_like(self.valid)
+        return state
+
+    def saved_flops(self):
+        return self.hits * self.flops_per_slot
+
+    def report(self):
+        return f"hits = {self.hits}, misses = {self.misses}, saved = {self.saved_flops() / 1e9:.2f} GFLOPs"
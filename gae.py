@@ -0,0 +1,142 @@
+import functools
+
+import torch
+
+
+def compute_gae(rewards, values, dones, next_value, gamma, gae_lambda, method="script", chunk_size=16):
+    """
+    Generalized advantage estimation over a whole rollout without a per-step Python loop.
+
+    Matches the original loop in main.py: the bootstrap of step t is masked with
+    dones[t + 1], and the last step uses dones[-1] and next_value.
+
+    Args:
+        rewards, values, dones: (num_steps, num_envs) tensors
+        next_value: (1, num_envs) value used to bootstrap the last step
+        gamma: discount factor
+        gae_lambda: lambda of the general advantage estimation
+        method: "script" (TorchScript scan, the faster on CPU) or "chunked" (masked discount matrices)
+        chunk_size: number of steps handled at once by the chunked method
+
+    Returns:
+        advantages, returns
+    """
+    nextnonterminal = _next_nonterminal(dones, rewards.dtype)
+    nextvalues = torch.cat([values[1:], next_value.reshape(1, -1)], dim=0)
+    deltas = rewards + gamma * nextvalues * nextnonterminal - values
+    init = torch.zeros_like(values[-1])
+    advantages = _discounted_scan(deltas, nextnonterminal, gamma * gae_lambda, init, method, chunk_size)
+    return advantages, advantages + values
+
+
+def compute_returns(rewards, values, dones, next_value, gamma, method="script", chunk_size=16):
+    """
+    Discounted returns bootstrapped from next_value, the --gae False branch of main.py.
+
+    Returns:
+        advantages, returns
+    """
+    nextnonterminal = _next_nonterminal(dones, rewards.dtype)
+    init = next_value.reshape(-1).to(rewards.dtype)
+    returns = _discounted_scan(rewards, nextnonterminal, gamma, init, method, chunk_size)
+    return returns - values, returns
+
+
+def _next_nonterminal(dones, dtype):
+    # Step t is masked with dones[t + 1], the last step with its own done flag
+    nextdones = torch.cat([dones[1:], dones[-1:]], dim=0)
+    return (~nextdones).to(dtype)
+
+
+def _discounted_scan(x, mask, discount, init, method, chunk_size):
+    """Solves y[t] = x[t] + discount * mask[t] * y[t + 1] backwards in time, with y[num_steps] = init."""
+    match method:
+        case "chunked":
+            return _chunked_scan(x, mask, discount, init, chunk_size)
+        case "script":
+            return _script_scan()(x, discount * mask, init)
+        case default:
+            raise ValueError(f"Unknown scan method: {method}")
+
+
+def _chunked_scan(x, mask, discount, init, chunk_size):
+    """
+    Processes the rollout in chunks, from the last one to the first.
+
+    Inside a chunk y[i] = sum_k W[i, k] x[k] + carry[i] * y_next, where
+    W[i, k] = discount^(k - i) if k >= i and there is no terminal in [i, k), else 0.
+    Terminals are counted with a cumulative sum, so no division by a cumulative
+    product (which breaks on the zeros of the mask) is needed.
+    """
+    num_steps = x.shape[0]
+    out = torch.empty_like(x)
+    y_next = init
+    for end in range(num_steps, 0, -chunk_size):
+        start = max(0, end - chunk_size)
+        length = end - start
+        steps = torch.arange(length + 1, device=x.device)
+
+        # terminals[i] = number of masked steps in [start, start + i)
+        terminals = torch.zeros((length + 1,) + x.shape[1:], dtype=x.dtype, device=x.device)
+        terminals[1:] = torch.cumsum(1 - mask[start:end], dim=0)
+
+        # (length, length + 1, num_envs) weights, the last column is the carry from the next chunk
+        offsets = steps[None, :] - steps[:length, None]
+        powers = torch.where(offsets >= 0, discount ** offsets.clamp(min=0).to(x.dtype), torch.zeros((), dtype=x.dtype, device=x.device))
+        connected = terminals[None, :] == terminals[:length, None]
+        weights = powers.unsqueeze(-1) * connected
+
+        out[start:end] = (weights[:, :length] * x[start:end]).sum(dim=1) + weights[:, length] * y_next
+        y_next = out[start]
+    return out
+
+
+@functools.cache
+def _script_scan():
+    # Scripted on first use, not at import (every spawned worker imports this module)
+    return torch.jit.script(_scan)
+
+
+def _scan(x: torch.Tensor, coef: torch.Tensor, init: torch.Tensor) -> torch.Tensor:
+    out = torch.empty_like(x)
+    y = init
+    for t in range(x.shape[0] - 1, -1, -1):
+        y = x[t] + coef[t] * y
+        out[t] = y
+    return out
+
+
+def compute_vtrace(rewards, values, dones, next_value, behaviour_logprobs, target_logprobs, gamma, rho_bar=1.0, c_bar=1.0):
+    """
+    V-trace targets (Espeholt et al., 2018) for a rollout collected by an older copy of the policy.
+
+    Same step convention as compute_gae. The importance weights of the target policy
+    over the behaviour policy are truncated at rho_bar for the temporal differences
+    and at c_bar for the traces. With both weights equal to 1 (on-policy data) vs are
+    the returns of compute_returns.
+
+    Args:
+        rewards, values, dones: (num_steps, num_envs) tensors, values of the target policy
+        next_value: (1, num_envs) value used to bootstrap the last step
+        behaviour_logprobs: (num_steps, num_envs) log probabilities of the actions under the policy that collected them
+        target_logprobs: (num_steps, num_envs) log probabilities of the actions under the policy being trained
+        gamma: discount factor
+        rho_bar, c_bar: truncation levels of the importance weights
+
+    Returns:
+        vs (value targets), pg_advantages (advantages of the policy gradient)
+    """
+    nextnonterminal = _next_nonterminal(dones, rewards.dtype)
+    ratio = (target_logprobs - behaviour_logprobs).exp()
+    rhos = ratio.clamp(max=rho_bar)
+    cs = ratio.clamp(max=c_bar)
+    next_value = next_value.reshape(1, -1)
+
+    nextvalues = torch.cat([values[1:], next_value], dim=0)
+    deltas = rhos * (rewards + gamma * nextvalues * nextnonterminal - values)
+    # The traces are not 0/1 masks, only the sequential scan handles them
+    vs = values + _script_scan()(deltas, gamma * nextnonterminal * cs, torch.zeros_like(values[-1]))
+
+    next_vs = torch.cat([vs[1:], next_value], dim=0)
+    pg_advantages = rhos * (rewards + gamma * next_vs * nextnonterminal - values)
+    return vs, pg_advantages
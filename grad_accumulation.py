@@ -0,0 +1,68 @@
+import torch
+
+
+def micro_batches(mb_inds, micro_batch_size):
+    """Splits the indices of a minibatch in consecutive micro-batches, returns (start, end) pairs."""
+    return [(start, min(start + micro_batch_size, len(mb_inds))) for start in range(0, len(mb_inds), micro_batch_size)]
+
+
+def peak_memory(agent, obs_shape, batch_size, device):
+    """Peak allocated memory (MB) of a forward and backward pass of get_action_and_value on batch_size observations."""
+    obs = torch.randint(0, 256, (batch_size,) + tuple(obs_shape), dtype=torch.uint8, device=device)
+    actions = torch.zeros(batch_size, dtype=torch.long, device=device)
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    try:
+        _, logprob, entropy, value = agent.get_action_and_value(obs, actions)
+        (logprob.sum() + entropy.sum() + value.sum()).backward()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) / 1024**2
+    except torch.cuda.OutOfMemoryError:
+        return float("inf")
+    finally:
+        agent.zero_grad(set_to_none=True)
+        del obs, actions
+        torch.cuda.empty_cache()
+
+
+def find_micro_batch_size(agent, obs_shape, minibatch_size, memory_budget, device):
+    """
+    Returns the largest micro-batch size whose update step fits in memory_budget MB.
+
+    The peak memory of a forward and backward pass is measured for the candidate
+    sizes with a binary search between 1 and minibatch_size. It includes everything
+    already on the device (model, rollout buffer). Adam creates its state (exp_avg
+    and exp_avg_sq) on the first step, after the search, so twice the size of the
+    trainable parameters is kept free for it. The state of the agent (BatchNorm
+    running stats) is restored after the measurements. The peak memory is only
+    tracked on CUDA, on other devices the whole minibatch is used.
+
+    Args:
+        agent: Agent that will be trained
+        obs_shape: shape of one stored observation
+        minibatch_size: logical minibatch size of the PPO update
+        memory_budget: memory budget in MB
+        device: device of the agent
+    """
+    if device.type != "cuda":
+        print(f"Memory budget is only measured on CUDA, using micro_batch_size = {minibatch_size}")
+        return minibatch_size
+
+    optimizer_state = 2 * sum(p.numel() * p.element_size() for p in agent.parameters() if p.requires_grad) / 1024**2
+    memory_budget -= optimizer_state
+    print(f"Memory kept for the optimizer state = {optimizer_state:.2f} MB")
+
+    state_dict = {name: value.clone() for name, value in agent.state_dict().items()}
+    compiled, agent.compiled = agent.compiled, False  # don't build a graph for every candidate
+    low, high = 1, minibatch_size
+    while low < high:
+        size = (low + high + 1) // 2
+        peak = peak_memory(agent, obs_shape, size, device)
+        print(f"Micro-batch {size}: peak memory = {peak:.2f} MB")
+        if peak <= memory_budget:
+            low = size
+        else:
+            high = size - 1
+    agent.compiled = compiled
+    agent.load_state_dict(state_dict)
+    return low
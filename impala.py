@@ -0,0 +1,177 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.tensorboard import SummaryWriter
+
+from actors import ActorPool
+from env_backend import make_env, register_custom_maps
+from evaluation import evaluate
+from gae import compute_vtrace
+from grad_accumulation import find_micro_batch_size, micro_batches
+from main import Agent, parse_args as parse_main_args, resolve_amp_dtype
+
+
+def parse_args():
+    """Options of the actor/learner split, every other option (agent, env, PPO coefficients) is the one of main.py."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-actors", type=int, default=2,
+                        help="number of actor processes, each with --num-envs envs")
+    parser.add_argument("--queue-size", type=int, default=4,
+                        help="number of trajectory slots beyond one per actor, trajectories waiting for the learner")
+    parser.add_argument("--learner-batch", type=int, default=2,
+                        help="number of trajectories in one learner update")
+    parser.add_argument("--num-updates", type=int, default=1000,
+                        help="number of learner updates")
+    parser.add_argument("--rho-bar", type=float, default=1.0,
+                        help="truncation of the V-trace importance weights of the temporal differences")
+    parser.add_argument("--c-bar", type=float, default=1.0,
+                        help="truncation of the V-trace traces")
+    parser.add_argument("--actor-threads", type=int, default=1,
+                        help="torch threads of each actor")
+    parser.add_argument("--log-frequency", type=int, default=10,
+                        help="the number of updates between two logs")
+    parser.add_argument("--task", type=str, default="Default-Conf-v1")
+    args, main_argv = parser.parse_known_args()
+    return args, parse_main_args(main_argv)
+
+
+if __name__ == "__main__":
+    impala_args, args = parse_args()
+    run_name = f"{args.exp_name}_impala"
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+    writer = SummaryWriter(f"runs/{run_name}")
+    writer.add_text(
+        "hyperparameters",
+        "|param|value|\n|-|-|\n%s" % ("\n".join([f"|{key}|{value}|" for key, value in {**vars(args), **vars(impala_args)}.items()])),
+    )
+
+    register_custom_maps(args.env_backend, args.env_floder)
+    env_kwargs = dict(
+        backend=args.env_backend,
+        max_episode_steps=1250,
+        infinite_ammo=False,
+        terminate_on_ammo_depletion=True,
+        initial_ammo=100,
+    )
+    test_envs = [make_env(task=impala_args.task, num_envs=10, **env_kwargs)]
+    observation_space_shape = test_envs[0].observation_space.shape
+    action_space_number = test_envs[0].action_space.n
+
+    agent_kwargs = dict(
+        observation_space_shape=observation_space_shape,
+        num_actions=action_space_number,
+        network_type=args.network_type,
+        actor_critic_mlp=args.ac_mlp,
+        pretrained_adapt=args.pretrained_adapt,
+        forward_type=args.forward_type,
+        use_lora=args.use_lora,
+        args=args,
+    )
+    agent = Agent(**agent_kwargs).to(device)
+    optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
+    # Gradient scaling is only needed with fp16, bf16 has the range of fp32
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp and resolve_amp_dtype(device.type, args.amp_dtype) == torch.float16)
+
+    # Le traiettorie arrivano dagli attori mentre il learner aggiorna la policy
+    actors = ActorPool(agent, agent_kwargs, {**env_kwargs, "num_envs": args.num_envs}, impala_args.task, args.env_floder,
+                       impala_args.num_actors, args.num_steps, queue_size=impala_args.queue_size, seed=args.seed + 1,
+                       num_threads=impala_args.actor_threads)
+
+    # The learner batch is learner_batch * num_envs * num_steps observations, the forward and backward passes
+    # run on micro-batches of the size of a PPO physical batch of main.py
+    learner_batch_size = impala_args.learner_batch * args.num_envs * args.num_steps
+    micro_batch_size = args.micro_batch_size if args.micro_batch_size > 0 else args.minibatch_size
+    if args.micro_batch_size == 0 and args.memory_budget > 0:
+        obs_channels = agent.input_channels(observation_space_shape[0])
+        stored_obs_shape = (obs_channels.stop - obs_channels.start,) + observation_space_shape[1:]
+        micro_batch_size = find_micro_batch_size(agent, stored_obs_shape, learner_batch_size, args.memory_budget, device)
+    print(f"Learner batch size = {learner_batch_size}, micro-batch size = {micro_batch_size}")
+
+    global_step = 0
+    start_time = time.time()
+    for update in range(impala_args.num_updates):
+        if args.anneal_lr:
+            optimizer.param_groups[0]["lr"] = (1.0 - update / impala_args.num_updates) * args.learning_rate
+
+        # (num_steps, num_envs of all the trajectories, ...)
+        batch, trajectories = actors.get(impala_args.learner_batch, device)
+        obs, actions, behaviour_logprobs, rewards, dones = [batch[name] for name in ["obs", "actions", "logprobs", "rewards", "dones"]]
+        num_steps, num_envs = actions.shape
+
+        b_obs = obs.reshape((-1,) + obs.shape[2:])
+        b_actions = actions.reshape(-1)
+        b_inds = np.arange(len(b_actions))
+
+        # Off-policy correction for the policy lag of the actors, the bootstrap is the value of the last observation as in main.py
+        with torch.no_grad():
+            newlogprob = torch.empty(len(b_actions), device=device)
+            newvalue = torch.empty(len(b_actions), device=device)
+            for start, end in micro_batches(b_inds, micro_batch_size):
+                _, logprob, _, value = agent.get_action_and_value(b_obs[start:end], b_actions[start:end])
+                newlogprob[start:end] = logprob
+                newvalue[start:end] = value.view(-1)
+            newlogprob = newlogprob.view(num_steps, num_envs)
+            newvalue = newvalue.view(num_steps, num_envs)
+            vs, pg_advantages = compute_vtrace(rewards, newvalue, dones, newvalue[-1], behaviour_logprobs, newlogprob,
+                                               args.gamma, impala_args.rho_bar, impala_args.c_bar)
+        b_vs = vs.reshape(-1)
+        b_pg_advantages = pg_advantages.reshape(-1)
+
+        # Gradient accumulation: the loss of each micro-batch is weighted by its share of the batch
+        optimizer.zero_grad()
+        pg_loss, v_loss, entropy_loss = 0.0, 0.0, 0.0
+        for start, end in micro_batches(b_inds, micro_batch_size):
+            weight = (end - start) / len(b_inds)
+            _, u_logprob, entropy, u_value = agent.get_action_and_value(b_obs[start:end], b_actions[start:end])
+            u_pg_loss = -(b_pg_advantages[start:end] * u_logprob).mean()
+            u_v_loss = 0.5 * ((b_vs[start:end] - u_value.view(-1)) ** 2).mean()
+            u_entropy_loss = entropy.mean()
+            loss = u_pg_loss - args.ent_coef * u_entropy_loss + u_v_loss * args.vf_coef
+            scaler.scale(loss * weight).backward()
+
+            pg_loss += u_pg_loss.detach() * weight
+            v_loss += u_v_loss.detach() * weight
+            entropy_loss += u_entropy_loss.detach() * weight
+
+        scaler.unscale_(optimizer)
+        nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
+        scaler.step(optimizer)
+        scaler.update()
+        actors.publish(agent)
+        global_step += sum(t["num_transitions"] for t in trajectories)
+
+        if (update + 1) % impala_args.log_frequency == 0:
+            stats = actors.stats()
+            sps = int(global_step / (time.time() - start_time))
+            writer.add_scalar("charts/learning_rate", optimizer.param_groups[0]["lr"], global_step)
+            writer.add_scalar("losses/value_loss", v_loss.item(), global_step)
+            writer.add_scalar("losses/policy_loss", pg_loss.item(), global_step)
+            writer.add_scalar("losses/entropy", entropy_loss.item(), global_step)
+            writer.add_scalar("charts/SPS", sps, global_step)
+            for name, value in stats.items():
+                writer.add_scalar(f"charts/{name}", value, global_step)
+            print(f"update {update + 1}, global_step={global_step}, SPS={sps}, actor utilization={stats['actor_utilization']:.2f}, "
+                  f"learner utilization={stats['learner_utilization']:.2f}, policy lag={stats['policy_lag']:.2f}")
+
+    actors.close()
+
+    with agent.merged_lora():
+        results = evaluate(agent, test_envs, device, max_steps=1250)
+    for result in results:
+        print(f"{impala_args.task} - global_step={global_step}, mean_episodic_return={result['mean_return']:.2f}, "
+              f"mean_episodic_len={result['mean_len']}, Kills={result['kills']:.2f}")
+        writer.add_scalar(f"{impala_args.task}/reward", result["mean_return"], global_step)
+        writer.add_scalar(f"{impala_args.task}/kills", result["kills"], global_step)
+
+    writer.close()
+    for test_env in test_envs:
+        test_env.close()
+    os.makedirs("models", exist_ok=True)
+    torch.save(agent, f"models/{run_name}.pth")
@@ -1,5 +1,7 @@
 import argparse
+import contextlib
 import functools
+import math
 import os
 import random
 import signal
@@ -16,18 +18,17 @@ from torch import int8
 from torch.distributions.categorical import Categorical
 from torch.utils.tensorboard import SummaryWriter
 from torchvision import models
-from envpool.vizdoom.registration import register_custom_folder
 
 import torch
 import numpy as np
 import cv2
-import envpool  # Assuming envpool is being used for the environment
 import imageio
 import pynvml # Monitoring GPU
 
 from transformers import AutoModelForImageClassification
 from transformers import SwinForImageClassification
 from peft import LoraConfig, get_peft_model, TaskType
+from peft.tuners.lora import LoraLayer as PeftLoraLayer
 
 import threading
 import time
@@ -45,6 +46,21 @@ import multiprocessing as mp
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from run_state import CheckpointWriter, load_checkpoint, load_model_state, model_state, rng_state, set_rng_state
+from checkpointing import checkpoint_stages
+from distributed import (all_reduce_gradients, broadcast_buffers, broadcast_state, global_mean, global_mean_std,
+                         init_distributed)
+from env_backend import MultiTaskEnv, make_env, register_custom_maps
+from evaluation import EvalWorker, evaluate
+from feature_cache import SlotCache
+from gae import compute_gae, compute_returns
+from grad_accumulation import find_micro_batch_size, micro_batches
+from preprocess import InputPreprocessor
+from profiling import PhaseTimer
+from rollout import RolloutCollector
+from rollout_buffer import RolloutBuffer
+from transfer import HostToDevice
+
 def get_most_free_gpu():
     """Finds the GPU with the most free memory using nvidia-smi."""
     try:
@@ -71,6 +87,19 @@ def get_gpu_memory(device):
         'free': mem_info.free / 1024**2     # Memoria libera in MB
     }
     
+def resolve_amp_dtype(device_type, amp_dtype="auto"):
+    """Returns the autocast dtype, auto is fp16 on CUDA and bf16 on CPU."""
+    match amp_dtype:
+        case "auto":
+            return torch.float16 if device_type == "cuda" else torch.bfloat16
+        case "bf16":
+            return torch.bfloat16
+        case "fp16":
+            return torch.float16
+        case default:
+            raise ValueError(f"Unknown amp dtype: {amp_dtype}")
+
+
 def save_frames_as_gif(frames, filename="episode_recording.gif"):
     """z
     Saves a list of frames as a GIF file.
@@ -134,84 +163,45 @@ def log_matrix_with_heatmap(matrix, tasks, name, vmin=0, vmax=1, cmap='YlOrRd'):
 
 def test(model, test_envs, env_names, global_step, save_gif=False, trackmatrix=False):
     print(f"Testing - Global Steps: {global_step} Time {time.time() - start_time}")
-    model.eval()
-
-    with torch.no_grad():
-        for i, test_env in enumerate(test_envs):
-
-            next_obs, _ = test_env.reset()
-            next_obs = torch.Tensor(next_obs).to(device)
-            episode_rewards = np.zeros(10)
-            episode_len = np.zeros(10)
-
-            sum_len = 0
-            sum_reward = 0
-            count_done = 0
-            kills = 0
-
-            frames = []
-            ep0_end = False
-
-            for _ in range(0, 1250):
-                # Action logic
-                with torch.no_grad():
-                    action, logprob, _, value = agent.get_action_and_value(next_obs)
-
-                # Execute game step
-                next_obs, reward, terminated, truncated, info = test_env.step(action.cpu().numpy())
-
-                next_done = torch.tensor(terminated | truncated).to(int8).numpy()
-                if not ep0_end:
-                    frames.append(next_obs[0][-3:])
-                    #frames.append(next_obs[0][:3])
-                    #frames.append(next_obs[0][3:6])
-                    #frames.append(next_obs[0][6:9])
-                    #frames.append(next_obs[0][9:])
-
-                episode_rewards += reward
-                episode_len += 1
-
-                if next_done[0]:
-                    ep0_end = True
-
-                count_done += sum(next_done)
-                sum_reward += sum(episode_rewards[next_done == 1])
-                kills += sum(info["KILLCOUNT_TOTAL"][next_done == 1])
-                sum_len += sum(episode_len[next_done == 1])
-                episode_rewards[next_done == 1] = 0
-                episode_len[next_done == 1] = 0
-
-                # Process next observation
-                next_obs = torch.Tensor(next_obs).to(device)
-                if count_done >= 10: break
-
-            mean_return = sum_reward / count_done
-            mean_len = sum_len / count_done
-            kills = kills / count_done
-            success = (kills - 3.5) / 26.5
-
-            print(
-                f"{env_names[i]} - global_step={global_step}, mean_episodic_return={mean_return:.2f}, mean_episodic_len={mean_len}, Kills={kills:.2f}, Success={success:.2f}")
-            writer.add_scalar(f"{env_names[i]}/episode_len", mean_len, global_step)
-            writer.add_scalar(f"{env_names[i]}/reward", mean_return, global_step)
-            writer.add_scalar(f"{env_names[i]}/kills", kills, global_step)
-            writer.add_scalar(f"{env_names[i]}/success", success, global_step)
-            # try:
-            if save_gif: 
-                os.makedirs("gifs", exist_ok=True)
-                save_frames_as_gif(frames=frames, filename=f"gifs/{env_names[i]}_{global_step}.gif")
-            # except:
-            #     print("Error saving image")
-
-            if trackmatrix:
-                results_matrix[current_task][i] = kills
-    model.train()
-
-
-def parse_args():
+    with model.merged_lora():
+        results = evaluate(model, test_envs, device, max_steps=1250, record_frames=save_gif)
+    log_test_results(results, env_names, global_step, save_gif, current_task if trackmatrix else None)
+
+
+def log_test_results(results, env_names, global_step, save_gif=False, task=None):
+    """Logs the results of evaluate(), task is the row of results_matrix to fill (None to skip it)."""
+    for i, result in enumerate(results):
+        mean_return = result["mean_return"]
+        mean_len = result["mean_len"]
+        kills = result["kills"]
+        success = result["success"]
+
+        print(
+            f"{env_names[i]} - global_step={global_step}, mean_episodic_return={mean_return:.2f}, mean_episodic_len={mean_len}, Kills={kills:.2f}, Success={success:.2f}")
+        writer.add_scalar(f"{env_names[i]}/episode_len", mean_len, global_step)
+        writer.add_scalar(f"{env_names[i]}/reward", mean_return, global_step)
+        writer.add_scalar(f"{env_names[i]}/kills", kills, global_step)
+        writer.add_scalar(f"{env_names[i]}/success", success, global_step)
+        if save_gif:
+            os.makedirs("gifs", exist_ok=True)
+            save_frames_as_gif(frames=result["frames"], filename=f"gifs/{env_names[i]}_{global_step}.gif")
+
+        if task is not None:
+            results_matrix[task][i] = kills
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--exp-name", type=str, default="ppo_vanilla",
                         help="the name of this experiment")
+    parser.add_argument("--profile-phases", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, time and memory of every phase of the loop are logged (synchronizes the device)")
+    parser.add_argument("--profile-window", type=int, nargs=2, default=None,
+                        help="first and last update traced with torch.profiler")
+    parser.add_argument("--async-eval", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, evaluation runs in a separate process while training continues")
+    parser.add_argument("--eval-frequency", type=int, default=20,
+                        help="the number of updates between two evaluations")
     parser.add_argument("--learning-rate", type=float, default=2.5e-5,
                         help="the learning rate of the optimizer")# 1.0e-3 lr, 2.5e-4 default, 1.0e-4 lrl, 2.5e-5 lrl--
     parser.add_argument("--seed", type=int, default=9,
@@ -233,6 +223,17 @@ def parse_args():
 
     parser.add_argument("--env-floder", type=str, default=os.getcwd() + '/run_and_gun',
                         help="Folder with custom maps")
+    parser.add_argument("--env-backend", type=str, default="envpool", nargs="?", const="envpool",
+                        help="the environment implementation")#envpool, synthetic
+
+    parser.add_argument("--checkpoint-frequency", type=int, default=50,
+                        help="the number of updates between two checkpoints, 0 disables them")
+    parser.add_argument("--checkpoint-dir", type=str, default="checkpoints",
+                        help="folder of the checkpoints, one file per experiment name")
+    parser.add_argument("--resume", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the run restarts from the checkpoint of the experiment")
+    parser.add_argument("--dist-backend", type=str, default="gloo",
+                        help="backend of torch.distributed when launched with torchrun")#gloo, nccl
 
     parser.add_argument("--s-p", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
                         help="if toggled, this use shrink and perturb")
@@ -250,6 +251,26 @@ def parse_args():
                         help="how input frames are passed to the network")#single_frame, multi_frame_patch_concat, conv_adapter
     parser.add_argument("--use-lora", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
                         help="if toggled, you use LoRA in pretrained nets")
+    parser.add_argument("--freeze-backbone", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the backbone is frozen and its features are computed once per rollout, the update trains actor and critic")
+    parser.add_argument("--grad-checkpoint", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the activations of the backbone stages are recomputed in the backward pass")
+    parser.add_argument("--cache-embeddings", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the frozen patch embeddings of multi_frame_patch_concat are computed once per rollout")
+    parser.add_argument("--amp", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the backbone runs under autocast in rollout, update and evaluation")
+    parser.add_argument("--amp-dtype", type=str, default="auto", nargs="?", const="auto",
+                        help="the autocast dtype, auto is fp16 on cuda and bf16 on cpu")#auto, bf16, fp16
+    parser.add_argument("--compile-policy", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the forward pass of the agent is compiled with torch.compile")
+    parser.add_argument("--compile-cache-dir", type=str, default="compile_cache",
+                        help="folder where the torch.compile artifacts are kept between runs")
+    parser.add_argument("--compile-preprocess", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, channel selection, resize and scaling of the input are compiled with torch.compile")
+    parser.add_argument("--cache-inputs", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, the resized input frames are computed once per rollout")
+    parser.add_argument("--obs-storage", type=str, default="dense", nargs="?", const="dense",
+                        help="how rollout observations are stored")#dense, frame_ring
     
      # LoRA specific arguments
     parser.add_argument("--lora-rank", type=int, default=16,
@@ -262,12 +283,18 @@ def parse_args():
                         help="the number of parallel game environments")
     parser.add_argument("--num-steps", type=int, default=128,
                         help="the number of steps to run in each environment per policy rollout")
+    parser.add_argument("--async-batches", type=int, default=1,
+                        help="the number of env batches stepped concurrently, 1 is the synchronous rollout")
+    parser.add_argument("--concurrent-tasks", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+                        help="if toggled, all the run_and_gun scenarios are rolled out together, --num-envs is split among them")
     parser.add_argument("--updates-per-env", type=int, default=500,
                         help="the number of steps to run in each environment")
     parser.add_argument("--anneal-lr", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=False,
                         help="Toggle learning rate annealing for policy and value networks")
     parser.add_argument("--gae", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
                         help="Use GAE for advantage computation")
+    parser.add_argument("--gae-method", type=str, default="script", nargs="?", const="script",
+                        help="how advantages and returns are computed, script is faster on CPU (bench_gae.py)")#script, chunked
     parser.add_argument("--gamma", type=float, default=0.99,
                         help="the discount factor gamma")
     parser.add_argument("--gae-lambda", type=float, default=0.95,
@@ -276,6 +303,10 @@ def parse_args():
                         help="the number of mini-batches") #32 per swin, 4 per resnet, 8 per cnn
     parser.add_argument("--update-epochs", type=int, default=4,
                         help="the K epochs to update the policy") #4 per swin, 4 resnet
+    parser.add_argument("--micro-batch-size", type=int, default=0,
+                        help="the physical batch of the update, gradients are accumulated over the minibatch (0 is the whole minibatch)")
+    parser.add_argument("--memory-budget", type=float, default=0,
+                        help="if set (MB) and --micro-batch-size is 0, the largest micro-batch that fits is used")
     parser.add_argument("--norm-adv", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
                         help="Toggles advantages normalization")
     parser.add_argument("--clip-coef", type=float, default=0.2,
@@ -291,7 +322,7 @@ def parse_args():
     parser.add_argument("--target-kl", type=float, default=None,
                         help="the target KL divergence threshold")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args.batch_size = int(args.num_envs * args.num_steps)
     args.minibatch_size = int(args.batch_size // args.num_minibatches)
     return args
@@ -330,14 +361,17 @@ class Agent(nn.Module):
 '''
 
 class Agent(nn.Module):
-    def __init__(self, observation_space_shape, num_actions, network_type="cnn", actor_critic_mlp=False, pretrained_adapt=False, forward_type="single_frame", use_lora=False):
+    def __init__(self, observation_space_shape, num_actions, network_type="cnn", actor_critic_mlp=False, pretrained_adapt=False, forward_type="single_frame", use_lora=False, args=None):
         super().__init__()
         self.network_type = network_type
         self.actor_critic_mlp = actor_critic_mlp
         self.pretrained_adapt = pretrained_adapt
         self.forward_type = forward_type
         self.use_lora = use_lora
-        self.args = parse_args()
+        self.args = args if args is not None else parse_args()
+        self.embedding_cache = None
+        self.compiled = False
+        self.frozen_backbone = False
         
         print(f"Network Type : {self.network_type}")
         print(f"Actor-Critic is MLP : {self.actor_critic_mlp}")
@@ -393,13 +427,13 @@ class Agent(nn.Module):
                 self.conv_adapter = nn.Conv2d(observation_space_shape[0], 3, kernel_size=1)
                 self.network.head = nn.Identity()
                 if self.use_lora:
-                    self.apply_lora(self.network)
+                    self.network = self.apply_lora(self.network)
             case "swin_w_hf":
                 self.network = SwinForImageClassification.from_pretrained("microsoft/swin-tiny-patch4-window7-224")
                 self.conv_adapter = nn.Conv2d(observation_space_shape[0], 3, kernel_size=1)
                 self.network.classifier = nn.Identity()
                 if self.use_lora:
-                    self.apply_lora(self.network)
+                    self.network = self.apply_lora(self.network)
             case default:#TODO
                 self.network = nn.Sequential(
                     nn.Flatten(),
@@ -409,13 +443,22 @@ class Agent(nn.Module):
                     nn.ReLU()
                 )
         
+        # Selezione dei canali, resize e scala dell'input in un solo passo sui frame uint8
+        self.preprocess = InputPreprocessor(
+            num_channels=3 if self.forward_type == "single_frame" else 0,
+            size=(224, 224) if self.pretrained_adapt else None,
+            # conv_adapter scala dopo la convoluzione
+            scale=not (self.forward_type == "conv_adapter" and self.network_type != "cnn"),
+            compile=self.args.compile_preprocess,
+        )
+
         #print(self.network)        
-        #print(self.adapt_input(torch.randn(1, *observation_space_shape)).shape)
-        #print(self.network(self.adapt_input(torch.randn(1, *observation_space_shape))).shape)
+        #print(self.preprocess(torch.randn(1, *observation_space_shape)).shape)
+        #print(self.network(self.preprocess(torch.randn(1, *observation_space_shape))).shape)
         if self.network_type in ["cnn","resnet_s","swin_s","resnet_w","swin_w"]:
-            self.output_features = self.forward_backbone(self.adapt_input(torch.randn(1, *observation_space_shape))).shape[1]
+            self.output_features = self.forward_backbone(self.preprocess(torch.randn(1, *observation_space_shape))).shape[1]
         elif self.network_type in ["swin_w_hf"]:
-            self.output_features = self.forward_backbone(self.adapt_input(torch.randn(1, *observation_space_shape))).shape[1]
+            self.output_features = self.forward_backbone(self.preprocess(torch.randn(1, *observation_space_shape))).shape[1]
                 
         if actor_critic_mlp:
             self.actor = nn.Sequential(
@@ -432,21 +475,74 @@ class Agent(nn.Module):
             self.actor = nn.Linear(self.output_features, num_actions)
             self.critic = nn.Linear(self.output_features, 1)
             
-    def adapt_input(self, obs):
-        if self.pretrained_adapt:
-            obs = nn.functional.interpolate(obs, size=(224, 224), mode="nearest")
-        #print(obs.shape)    
-        return obs
-
-    def forward_backbone(self, obs):
+    def input_channels(self, num_channels):
+        """Returns the slice of the observation channels consumed by the selected forward type."""
+        if self.forward_type == "single_frame":
+            return slice(num_channels - 3, num_channels)
+        return slice(0, num_channels)
+
+    def enable_embedding_cache(self, num_slots, observation_space_shape, device):
+        """
+        Caches the frozen patch embeddings of multi_frame_patch_concat by rollout slot,
+        so they are computed during the rollout and reused by every update epoch.
+        """
+        h, w = (224, 224) if self.pretrained_adapt else observation_space_shape[1:]
+        projection = self.network.swin.embeddings.patch_embeddings.projection
+        tokens = math.ceil(h / projection.stride[0]) * math.ceil(w / projection.stride[1])
+        # Patch projection (multiply-add) and layer norm of the 4 frames
+        flops = 4 * tokens * (2 * projection.weight[0].numel() * projection.out_channels + 5 * projection.out_channels)
+        self.embedding_cache = SlotCache(num_slots, device, flops_per_slot=flops)
+
+    def freeze_backbone(self):
+        """
+        Freezes the backbone (and conv_adapter, which comes before it) and keeps it in eval mode,
+        so its features only depend on the observation and can be stored once per rollout.
+        """
+        self.frozen_backbone = True
+        for module in [self.network, getattr(self, "conv_adapter", None)]:
+            if module is not None:
+                module.requires_grad_(False)
+        self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.frozen_backbone:
+            # BatchNorm e dropout del backbone congelato restano in eval
+            self.network.eval()
+            if hasattr(self, "conv_adapter"):
+                self.conv_adapter.eval()
+        return self
+
+    def enable_grad_checkpoint(self):
+        """Recomputes the activations of the backbone stages in the backward pass of the update."""
+        match self.network_type:
+            case "resnet_s" | "resnet_w":
+                checkpoint_stages([self.network.layer1, self.network.layer2, self.network.layer3, self.network.layer4])
+            case "swin_s" | "swin_w":
+                checkpoint_stages(self.network.features)
+            case "swin_w_hf":
+                # Copre anche swin.encoder chiamato direttamente da multi_frame_patch_concat
+                self.network.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+            case default:
+                print(f"Gradient checkpointing not supported for {self.network_type}")
+
+    def reset_caches(self):
+        """Invalidates the per-rollout caches, called before every rollout."""
+        if self.embedding_cache is not None:
+            self.embedding_cache.reset()
+        if self.preprocess.cache is not None:
+            self.preprocess.cache.reset()
+
+    def forward_backbone(self, obs, slots=None):
+        # obs comes from self.preprocess: float, resized and (except for conv_adapter) in [0, 1]
         match self.forward_type:
             case "single_frame":
                 x = obs[:, -3:, :, :]
                 #print(x.shape)
                 if self.network_type in ["cnn","resnet_s","swin_s","resnet_w","swin_w"]:
-                    features = self.network(x / 255.0)
+                    features = self.network(x)
                 elif self.network_type in ["swin_w_hf"]:
-                    features = self.network(x / 255.0).logits
+                    features = self.network(x).logits
                 #print(features.shape)
                 return features
             case "multi_frame_patch_concat":
@@ -456,18 +552,21 @@ class Agent(nn.Module):
                 frames = obs.view(bs, num_frames, c // num_frames, h, w)  # (batch_size, num_frames, 3, H, W)
                 #print(frames.shape)
                 # Processa ogni frame indipendentemente
-                all_patches = []
-                for i in range(4):  
-                    frame = frames[:, i, :, :, :]  # Estrai il frame i-esimo (batch_size, 3, 84, 84)
-                    #print(frame.shape)
+                def embed_frames():
+                    # I frame vengono piegati nel batch: una sola chiamata su (batch_size * num_frames, 3, H, W)
                     if self.network_type in ["resnet_s","swin_s","resnet_w","swin_w"]:
                         print("Not implemented")
                     elif self.network_type in ["swin_w_hf"]:
                         with torch.no_grad():
-                            embeddings = self.network.swin.embeddings(frame / 255.0)[0]
-                            all_patches.append(embeddings)
-                        #print(self.network.swin.embeddings(frame / 255.0)[0])
-                concatenated_patches = torch.cat(all_patches, dim=1)
+                            embeddings = self.network.swin.embeddings(frames.reshape(bs * num_frames, c // num_frames, h, w))[0]
+                        # (batch_size * num_frames, L, D) -> (batch_size, num_frames * L, D), come il cat sui frame
+                        return embeddings.reshape(bs, num_frames * embeddings.shape[1], embeddings.shape[2])
+
+                # The embeddings are frozen, with the cache they are computed once per rollout
+                if self.embedding_cache is not None and slots is not None:
+                    concatenated_patches = self.embedding_cache.lookup(slots, embed_frames)
+                else:
+                    concatenated_patches = embed_frames()
                 #print(f"First-layer patch embeddings shape: {concatenated_patches.shape}")
                 features = []
                 if self.network_type in ["swin_w_hf"]:
@@ -487,26 +586,22 @@ class Agent(nn.Module):
                 # Splitta l'input in 4 frame separati
                 frames = obs.view(bs, num_frames, c // num_frames, h, w)  # (batch_size, num_frames, 3, H, W)
                 #print(frames.shape)
-                # Processa ogni frame indipendentemente
-                outputs = []
-                for i in range(4):  
-                    frame = frames[:, i, :, :, :]  # Estrai il frame i-esimo (batch_size, 3, 84, 84)
-                    #print(frame.shape)
-                    if self.network_type in ["resnet_s","swin_s","resnet_w","swin_w"]:
-                        outputs.append(self.network(frame / 255.0))
-                    elif self.network_type in ["swin_w_hf"]:
-                        outputs.append(self.network(frame / 255.0).logits)
+                # Processa tutti i frame in una sola chiamata, piegati nel batch
+                frames = frames.reshape(bs * num_frames, c // num_frames, h, w)
+                if self.network_type in ["resnet_s","swin_s","resnet_w","swin_w"]:
+                    outputs = self.network(frames)
+                elif self.network_type in ["swin_w_hf"]:
+                    outputs = self.network(frames).logits
 
-                # Concatena i risultati e fai la media sui frame
-                outputs = torch.stack(outputs, dim=0)  # (num_frames, batch_size, num_classes)
+                # Media sui frame
+                outputs = outputs.view(bs, num_frames, -1)  # (batch_size, num_frames, num_classes)
                 #print(outputs.shape)
-                features = outputs.mean(dim=0)  # (batch_size, num_classes)
-                print(features.shape)
+                features = outputs.mean(dim=1)  # (batch_size, num_classes)
                 return features
             case "conv_adapter":
                 #print(x.shape)
                 if self.network_type in ["cnn"]:
-                    features = self.network(obs / 255.0)
+                    features = self.network(obs)
                 elif self.network_type in ["resnet_s","swin_s","resnet_w","swin_w"]:
                     x = self.conv_adapter(obs)
                     features = self.network(x / 255.0)
@@ -529,9 +624,19 @@ class Agent(nn.Module):
             
             modules_copy = list(model.named_modules())  
 
+            # attn.qkv e attn.proj sono letti come pesi da shifted_window_attention (il loro forward non
+            # viene chiamato), quindi LoRA va sui Linear dell'MLP
             for name, module in modules_copy:
-                if isinstance(module, nn.Linear) and ("attn" in name or "fc" in name):
-                    setattr(model, name, lora.Linear(module.in_features, module.out_features, r=self.args.lora_rank, lora_alpha=self.args.lora_alpha))
+                if isinstance(module, nn.Linear) and ("mlp" in name or "fc" in name):
+                    # merge_weights=False: i pesi vengono uniti solo da merge_lora(), non da eval()
+                    lora_linear = lora.Linear(module.in_features, module.out_features, r=self.args.lora_rank, lora_alpha=self.args.lora_alpha, merge_weights=False)
+                    lora_linear.weight.data.copy_(module.weight.data)
+                    lora_linear.bias.data.copy_(module.bias.data)
+                    # loralib congela solo weight, anche il bias pre-addestrato resta congelato
+                    lora_linear.bias.requires_grad = False
+                    # Sostituisce il modulo nel suo genitore, setattr sul modello con un nome puntato non lo sostituisce
+                    parent_name, _, child_name = name.rpartition(".")
+                    setattr(model.get_submodule(parent_name), child_name, lora_linear)
                     print(f"Applied LoRA to {name}")
                     
             for name, module in model.named_modules():
@@ -560,13 +665,14 @@ class Agent(nn.Module):
             '''
             
             # Definisci la configurazione di LoRA
+            # Nessun task_type: PeftModelForFeatureExtraction si aspetta input_ids, PeftModel passa pixel_values al modello
             lora_config = LoraConfig(
                 r=self.args.lora_rank,  # Riduzione della dimensione del rank
                 lora_alpha=self.args.lora_alpha,  # Fattore di scalatura
                 lora_dropout=0.1,  # Dropout per LoRA
                 bias="none",
-                task_type=TaskType.FEATURE_EXTRACTION,
-                target_modules=["query", "key", "value", "dense"],  # Layer target (attenzione e fully connected)
+                # Layer target (attenzione e fully connected), con i nomi di transformers 4 e 5
+                target_modules=["query", "key", "value", "dense", "q_proj", "k_proj", "v_proj", "o_proj", "fc1", "fc2"],
             )
             
             # Applica LoRA al modello usando PEFT
@@ -574,42 +680,167 @@ class Agent(nn.Module):
             model.print_trainable_parameters()
                 
         #print(model)
+        return model
+
+    def lora_layers(self):
+        """Returns the LoRA layers of the backbone, loralib (swin_w) or PEFT (swin_w_hf)."""
+        return [m for m in self.network.modules() if isinstance(m, (lora.LoRALayer, PeftLoraLayer))]
+
+    def merge_lora(self):
+        """
+        Folds the LoRA adapters into the base weights, the no-grad passes (rollout, evaluation)
+        then run at the cost of the base model. The base weights are kept, unmerge_lora()
+        restores them exactly instead of subtracting the adapters back.
+        """
+        layers = self.lora_layers()
+        self.lora_base_weights = [(m.weight if isinstance(m, lora.LoRALayer) else m.get_base_layer().weight).detach().clone() for m in layers]
+        for m in layers:
+            if isinstance(m, lora.LoRALayer):
+                m.weight.data += (m.lora_B @ m.lora_A) * m.scaling
+                m.merged = True
+            else:
+                m.merge()
+
+    def unmerge_lora(self):
+        """Restores the base weights, the update trains the adapters on top of them."""
+        for m, weight in zip(self.lora_layers(), self.lora_base_weights):
+            if isinstance(m, lora.LoRALayer):
+                m.weight.data.copy_(weight)
+                m.merged = False
+            else:
+                m.unmerge()
+                m.get_base_layer().weight.data.copy_(weight)
+        self.lora_base_weights = None
+
+    @contextlib.contextmanager
+    def merged_lora(self):
+        """Runs the block with the LoRA adapters merged, a no-op without LoRA."""
+        if not self.use_lora:
+            yield
+            return
+        self.merge_lora()
+        try:
+            yield
+        finally:
+            self.unmerge_lora()
+
+    def check_lora_merge(self, obs, atol=1e-4):
+        """
+        Checks that the merged model gives the same action logits and values as the unmerged one.
+        The check runs in fp32 outside self.autocast: with --amp the rounding of the half precision
+        forward alone is far larger than atol.
+        """
+        training = self.training
+        self.eval()
+        with torch.no_grad():
+            hidden = self.forward_backbone(self.preprocess(obs)).float()
+            reference = (self.actor(hidden), self.critic(hidden))
+            with self.merged_lora():
+                hidden = self.forward_backbone(self.preprocess(obs)).float()
+                merged = (self.actor(hidden), self.critic(hidden))
+        self.train(training)
+        error = max((a - b).abs().max().item() for a, b in zip(reference, merged))
+        print(f"LoRA merge check: max error = {error:.2e}")
+        if error > atol:
+            raise RuntimeError(f"LoRA merged and unmerged outputs differ by {error:.2e}")
             
-    def get_value(self, x):
-        x = self.adapt_input(x)
-        hidden = self.forward_backbone(x)
-        return self.critic(hidden)
-
-    def get_action_and_value(self, x, action=None):
-        x = self.adapt_input(x)
-        hidden = self.forward_backbone(x)
+    def autocast(self, device_type):
+        """Autocast context of the backbone, disabled unless --amp is set."""
+        return torch.autocast(device_type, dtype=resolve_amp_dtype(device_type, self.args.amp_dtype), enabled=self.args.amp)
+
+    def compile_policy(self):
+        """
+        Runs features() through torch.compile. The network_type/forward_type checks are
+        resolved while tracing, so each graph is specialized for this agent. The batch
+        dimension is dynamic: async rollout batches, the shrinking evaluation batch and
+        the last micro-batch all have different sizes, and a graph per size would hit
+        dynamo's recompile limit and fall back to eager. A batch of 1 gets its own graph.
+        """
+        self.compiled = True
+
+    def features(self, x, slots=None):
+        with self.autocast(x.device.type):
+            x = self.preprocess(x, slots)
+            hidden = self.forward_backbone(x, slots)
+        # Le teste restano in fp32: valori e logprob per il ratio di PPO
+        return hidden.float()
+
+    def encode(self, x, slots=None):
+        """Returns the features of the backbone, through the compiled graph if compile_policy() was called."""
+        if not self.compiled:
+            return self.features(x, slots)
+        torch._dynamo.maybe_mark_dynamic(x, 0)
+        return _compiled_features()(self, x, slots)
+
+    def get_value(self, x, slots=None):
+        return self.critic(self.encode(x, slots))
+
+    def get_action_and_value(self, x, action=None, slots=None):
+        return self.heads(self.encode(x, slots), action)
+
+    def heads(self, hidden, action=None):
+        """Actor and critic on the backbone features, used directly on the stored features of a frozen backbone."""
         logits = self.actor(hidden)
         probs = Categorical(logits=logits)
         if action is None:
             action = probs.sample()
         return action, probs.log_prob(action), probs.entropy(), self.critic(hidden)
 
+
+@functools.cache
+def _compiled_features():
+    # Built on first use and kept out of the Agent, so it can still be pickled
+    # dynamic=None: only the dimensions marked with maybe_mark_dynamic (the batch) are dynamic
+    return torch.compile(Agent.features, dynamic=None)
+
+
+def enable_compile_cache(cache_dir):
+    """Keeps the torch.compile artifacts in cache_dir, so later runs (e.g. a sweep) reuse the compiled kernels."""
+    import torch._functorch.config
+    import torch._inductor.config
+
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    torch._inductor.config.fx_graph_cache = True
+    torch._functorch.config.enable_autograd_cache = True
+
+
 if __name__ == "__main__":
     args = parse_args()
     run_name = f"{args.exp_name}"
 
-    # Seeding
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    # Con torchrun ogni processo ha i suoi env e il suo buffer (--num-envs e' per processo), i gradienti sono mediati
+    rank, world_size, local_rank = init_distributed(args.dist_backend)
+    is_main = rank == 0
+    if world_size > 1:
+        print(f"Rank {rank}/{world_size}: global batch size = {args.batch_size * world_size}")
+
+    # Seeding, the initial weights are broadcast from rank 0 after the agent is created
+    random.seed(args.seed + rank)
+    np.random.seed(args.seed + rank)
+    torch.manual_seed(args.seed + rank)
     torch.backends.cudnn.deterministic = args.torch_deterministic
     
 
     tasks = ["Default-Conf-v1"] #["Obstacles-v1", "Green-v1", "Resized-v1", "Monsters-v1", "Default-v1", "Red-v1", "Blue-v1", "Shadows-v1"]
+    if args.concurrent_tasks:
+        # Un solo rollout con gli env di tutti gli scenari invece di un curriculum sequenziale
+        tasks = ["Obstacles-v1", "Green-v1", "Resized-v1", "Monsters-v1", "Red-v1", "Blue-v1", "Shadows-v1", "Hard-v1"]
+        if args.num_envs % len(tasks) != 0:
+            raise ValueError(f"--num-envs must be a multiple of the {len(tasks)} tasks with --concurrent-tasks")
     current_task = 0
-    register_custom_folder(args.env_floder)
+    register_custom_maps(args.env_backend, args.env_floder)
 
     infinite_ammo = False
     terminate_on_ammo_depletion = True
     initial_ammo = 100
     max_episode_steps = 1250
 
-    batch_size = args.num_envs
+    # With more than one async batch, inference on a batch overlaps with the simulation of the others
+    task_num_envs = args.num_envs // len(tasks) if args.concurrent_tasks else args.num_envs
+    if task_num_envs % args.async_batches != 0:
+        raise ValueError(f"The {task_num_envs} envs of each task must be a multiple of --async-batches {args.async_batches}")
+    batch_size = task_num_envs // args.async_batches
 
     dict_envs = dict(zip(tasks, [None for _ in range(len(tasks))]))
     dict_test_envs = dict(zip(tasks, [None for _ in range(len(tasks))]))
@@ -617,12 +848,13 @@ if __name__ == "__main__":
     print("\n\nCreating main environments...")
     envs_cont = []
     for task in tasks:
-        env = envpool.make(
+        env = make_env(
+            args.env_backend,
             task,
-            env_type="gymnasium",
-            num_envs=args.num_envs,
+            num_envs=task_num_envs,
             batch_size=batch_size,
-            use_combined_action=True,
+            # Each rank owns a different shard of environments
+            seed=42 + rank * task_num_envs,
             max_episode_steps=max_episode_steps,
             infinite_ammo=infinite_ammo,
             terminate_on_ammo_depletion=terminate_on_ammo_depletion,
@@ -637,23 +869,25 @@ if __name__ == "__main__":
         envs_cont.append(env)
 
     print("---------------------------------------")
+    if args.concurrent_tasks:
+        envs_cont = [MultiTaskEnv(envs_cont, [task_num_envs] * len(tasks))]
     envs = envs_cont[current_task]
     observation_space_shape = envs.observation_space.shape
     action_space_number = envs.action_space.n
     #print(envs_cont)
+    test_env_kwargs = dict(
+        backend=args.env_backend,
+        num_envs=10,
+        max_episode_steps=max_episode_steps,
+        infinite_ammo=infinite_ammo,
+        terminate_on_ammo_depletion=terminate_on_ammo_depletion,
+        initial_ammo=initial_ammo,
+    )
     print("\n\nCreating test environments...")
     test_envs = []
-    for task in tasks:
-        env = envpool.make(
-            task,
-            env_type="gymnasium",
-            num_envs=10,
-            use_combined_action=True,
-            max_episode_steps=max_episode_steps,
-            infinite_ammo=infinite_ammo,
-            terminate_on_ammo_depletion=terminate_on_ammo_depletion,
-            initial_ammo=initial_ammo,
-        )
+    # With --async-eval the test environments live in the evaluation worker, only rank 0 evaluates
+    for task in (tasks if not args.async_eval and is_main else []):
+        env = make_env(task=task, **test_env_kwargs)
         print("---------------------------------------")
         print(task)
         test_env_observation_space = env.observation_space
@@ -664,7 +898,7 @@ if __name__ == "__main__":
 
     print("---------------------------------------")
     # Wandb setup
-    if args.track:
+    if args.track and is_main:
         import wandb
         mode = "offline" if args.offline else "online"
         wandb.init(
@@ -678,7 +912,8 @@ if __name__ == "__main__":
             save_code=True,
         )
 
-    writer = SummaryWriter(f"runs/{run_name}")
+    # The other ranks only log their own losses and phases, in a sub folder of the run
+    writer = SummaryWriter(f"runs/{run_name}" if is_main else f"runs/{run_name}/rank{rank}")
     writer.add_text(
         "hyperparameters",
         "|param|value|\n|-|-|\n%s" % ("\n".join([f"|{key}|{value}|" for key, value in vars(args).items()])),
@@ -687,19 +922,27 @@ if __name__ == "__main__":
     print("\n\nCUDA available")
     print("---------------------------------------")
     print(f"Available GPUs: {torch.cuda.device_count()}")
-    best_gpu, free_mem = get_most_free_gpu()
+    if world_size > 1:
+        best_gpu, free_mem = (local_rank, None) if args.cuda and torch.cuda.is_available() else (None, None)
+    else:
+        best_gpu, free_mem = get_most_free_gpu() if args.cuda else (None, None)
     if best_gpu is not None:
         print(f"Using GPU {best_gpu} with {free_mem} MB free.")
         device = torch.device(f"cuda:{best_gpu}")
     else:
         print("No GPU available, using CPU.")
         device = torch.device("cpu")
-    pynvml.nvmlInit()
-    device_nvml = pynvml.nvmlDeviceGetHandleByIndex(best_gpu)
-    memory = get_gpu_memory(device_nvml)
-    print(f"Memoria iniziale: Totale = {memory['total']} MB, Usata = {memory['used']} MB, Libera = {memory['free']} MB")
+    device_nvml = None
+    if best_gpu is not None:
+        pynvml.nvmlInit()
+        device_nvml = pynvml.nvmlDeviceGetHandleByIndex(best_gpu)
+        memory = get_gpu_memory(device_nvml)
+        print(f"Memoria iniziale: Totale = {memory['total']} MB, Usata = {memory['used']} MB, Libera = {memory['free']} MB")
     print("---------------------------------------")
         
+    if args.compile_policy or args.compile_preprocess:
+        enable_compile_cache(args.compile_cache_dir)
+
     print("\n\nAgent specific arguments")    
     print("---------------------------------------")
     #agent = Agent(envs).to(device)
@@ -709,7 +952,9 @@ if __name__ == "__main__":
                   actor_critic_mlp=args.ac_mlp, 
                   pretrained_adapt=args.pretrained_adapt, 
                   forward_type=args.forward_type, 
-                  use_lora=args.use_lora).to(device)
+                  use_lora=args.use_lora,
+                  args=args).to(device)
+    broadcast_state(agent)
     print("---------------------------------------\n\n")
     '''
     for name, param in agent.network.named_parameters():
@@ -718,8 +963,9 @@ if __name__ == "__main__":
     print(f"Memoria allocata per il modello: {torch.cuda.memory_allocated() / (1024**2):.2f} MB")
     print(f"Memoria riservata per il modello: {torch.cuda.memory_reserved() / (1024**2):.2f} MB")
     '''
-    memory = get_gpu_memory(device_nvml)
-    print(f"Memoria dopo creazione modello: Totale = {memory['total']} MB, Usata = {memory['used']} MB, Libera = {memory['free']} MB")
+    if device_nvml is not None:
+        memory = get_gpu_memory(device_nvml)
+        print(f"Memoria dopo creazione modello: Totale = {memory['total']} MB, Usata = {memory['used']} MB, Libera = {memory['free']} MB")
            
     if args.ewc:
         ewc = EWC(agent, ewc_lambda=250)
@@ -737,18 +983,82 @@ if __name__ == "__main__":
         {"params": agent.critic.parameters(), "lr": args.learning_rate},   
     ], eps=1e-5)
     '''
-    results_matrix = np.zeros([len(test_envs), len(test_envs)])
+    # Gradient scaling is only needed with fp16, bf16 has the range of fp32
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp and resolve_amp_dtype(device.type, args.amp_dtype) == torch.float16)
+    results_matrix = np.zeros([len(tasks), len(tasks)])
+
+    eval_worker = None
+    if args.async_eval and is_main:
+        agent_kwargs = dict(
+            observation_space_shape=observation_space_shape,
+            num_actions=action_space_number,
+            network_type=args.network_type,
+            actor_critic_mlp=args.ac_mlp,
+            pretrained_adapt=args.pretrained_adapt,
+            forward_type=args.forward_type,
+            use_lora=args.use_lora,
+            args=args,
+        )
+        eval_worker = EvalWorker(agent_kwargs, test_env_kwargs, tasks, args.env_floder, device=device)
+
+    def run_test(global_step, save_gif=False, trackmatrix=False):
+        """Evaluates the agent, in the evaluation worker if there is one. Returns the time the training loop was blocked."""
+        if not is_main:
+            return 0.0
+        test_time = time.time()
+        with timer.phase("eval"):
+            if eval_worker is not None:
+                # The evaluations at the end of a task fill results_matrix and are never skipped
+                eval_worker.submit(agent, global_step, save_gif, trackmatrix, current_task, block=trackmatrix)
+            else:
+                test(agent, test_envs, tasks, global_step, save_gif, trackmatrix)
+                print(f"Tested! Time elaplesed {time.time() - test_time}")
+                print()
+        return time.time() - test_time
+
+    def log_worker_results(block=False):
+        if eval_worker is None:
+            return
+        for job in eval_worker.poll(block=block):
+            print(f"Tested in background! Time elaplesed {job['time']}")
+            log_test_results(job["results"], tasks, job["global_step"], task=job["task"] if job["trackmatrix"] else None)
 
     # Storage setup
-    obs = torch.zeros((args.num_steps, args.num_envs) + envs.observation_space.shape).to(device)
-    actions = torch.zeros((args.num_steps, args.num_envs)).to(device).to(torch.int64)
-    logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    dones = torch.zeros((args.num_steps, args.num_envs)).to(device).to(torch.bool)
-    values = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    
-    memory = get_gpu_memory(device_nvml)
-    print(f"Memoria dopo storage: Totale = {memory['total']} MB, Usata = {memory['used']} MB, Libera = {memory['free']} MB")
+    # Only the channels used by the forward type are transferred and stored (the last frame for single_frame)
+    obs_channels = agent.input_channels(observation_space_shape[0])
+    stored_obs_shape = (obs_channels.stop - obs_channels.start,) + observation_space_shape[1:]
+    transfer = HostToDevice(device)
+    buffer = RolloutBuffer(args.num_steps, args.num_envs, stored_obs_shape, device,
+                           storage=args.obs_storage, num_frames=stored_obs_shape[0] // 3, transfer=transfer,
+                           feature_dim=agent.output_features if args.freeze_backbone else 0,
+                           task_ids=envs.task_ids if args.concurrent_tasks else None)
+    # With only --profile-window the phases are timed inside the window, where the trace is taken
+    timer = PhaseTimer(device, enabled=args.profile_phases)
+    collector = RolloutCollector(envs, buffer, transfer, obs_channels, timer=timer)
+    if args.cache_embeddings and args.forward_type == "multi_frame_patch_concat":
+        agent.enable_embedding_cache(args.batch_size, observation_space_shape, device)
+    if args.cache_inputs:
+        agent.preprocess.enable_cache(args.batch_size, device)
+    if args.freeze_backbone:
+        agent.freeze_backbone()
+    if args.grad_checkpoint:
+        agent.enable_grad_checkpoint()
+    if args.compile_policy:
+        agent.compile_policy()
+    micro_batch_size = args.micro_batch_size if args.micro_batch_size > 0 else args.minibatch_size
+    if args.micro_batch_size == 0 and args.memory_budget > 0:
+        micro_batch_size = find_micro_batch_size(agent, stored_obs_shape, args.minibatch_size, args.memory_budget, device)
+    print(f"Minibatch size = {args.minibatch_size}, micro-batch size = {micro_batch_size}")
+    actions = buffer.actions
+    logprobs = buffer.logprobs
+    rewards = buffer.rewards
+    dones = buffer.dones
+    values = buffer.values
+    print(buffer.report())
+
+    if device_nvml is not None:
+        memory = get_gpu_memory(device_nvml)
+        print(f"Memoria dopo storage: Totale = {memory['total']} MB, Usata = {memory['used']} MB, Libera = {memory['free']} MB")
     
     # Take a gif of an observation sample #TRY
     observation_sample = False
@@ -765,22 +1075,21 @@ if __name__ == "__main__":
         frames.append(next_obs[0][6:9])
         frames.append(next_obs[0][9:])
         '''
-        if(args.pretrained_adapt):
-            next_obs = agent.adapt_input(torch.from_numpy(next_obs))
-            
-        save_frames_as_gif(frames=[next_obs[0][:3].cpu().numpy()], filename=f"gifs/observation_sample_frame1.gif")
-        save_frames_as_gif(frames=[next_obs[0][3:6].cpu().numpy()], filename=f"gifs/observation_sample_frame2.gif")
-        save_frames_as_gif(frames=[next_obs[0][6:9].cpu().numpy()], filename=f"gifs/observation_sample_frame3.gif")
-        save_frames_as_gif(frames=[next_obs[0][9:].cpu().numpy()], filename=f"gifs/observation_sample_frame4.gif")
+        # I frame come li vede il backbone: canali selezionati e ridimensionati, in [0, 255]
+        next_obs = agent.preprocess(torch.from_numpy(next_obs).to(device))
+        if agent.preprocess.scale:
+            next_obs = next_obs * 255.0
+        next_obs = next_obs.to(torch.uint8)
+        for i in range(next_obs.shape[1] // 3):
+            save_frames_as_gif(frames=[next_obs[0][3 * i:3 * (i + 1)].cpu().numpy()], filename=f"gifs/observation_sample_frame{i + 1}.gif")
         observation_sample = False
 
-    # Initialize environments
-    envs.async_reset()
         
     # next_done = torch.zeros(batch_size).to(device)
     # Start training
     global_step = 0
     start_time = time.time()
+    eval_time = 0.0  # time spent in evaluation, excluded from the SPS
     num_updates = args.updates_per_env * len(tasks)
 
     # Initialize reward normalization variables
@@ -788,16 +1097,67 @@ if __name__ == "__main__":
     running_variance = 0.0
     count = 1e-8  # Small initial value to prevent division by zero
     
+    checkpoint_path = os.path.join(args.checkpoint_dir, f"{args.exp_name}.pt")
+    checkpoint_writer = CheckpointWriter()
+
+    def save_checkpoint(next_update):
+        # The state is the same on every rank
+        if not is_main:
+            return
+        checkpoint_writer.save({
+            # Con LoRA il resto del backbone e' quello preaddestrato, si salvano solo i parametri allenati
+            "agent": model_state(agent, trainable_only=args.use_lora),
+            "optimizer": optimizer.state_dict(),
+            "scaler": scaler.state_dict(),
+            "rng": rng_state(),
+            "update": next_update,
+            "global_step": global_step,
+            "current_task": current_task,
+            "results_matrix": results_matrix,
+            "train_time": time.time() - start_time - eval_time,
+        }, checkpoint_path)
+
+    start_update = 0
+    if args.resume:
+        checkpoint = load_checkpoint(checkpoint_path)
+        load_model_state(agent, checkpoint["agent"], trainable_only=args.use_lora)
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        start_update = checkpoint["update"]
+        global_step = checkpoint["global_step"]
+        current_task = checkpoint["current_task"]
+        results_matrix[:] = checkpoint["results_matrix"]
+        start_time = time.time() - checkpoint["train_time"]
+        # The envs can't be restored, they restart from a reset
+        envs = envs_cont[current_task]
+        # The saved RNG state is the one of rank 0, the other ranks keep their own seed
+        if is_main:
+            set_rng_state(checkpoint["rng"])
+        print(f"Resumed from {checkpoint_path}: update {start_update}, global_step {global_step}")
+
+    # Initialize environments, after the resume so the pool of the resumed task is the only one reset
+    collector.reset(envs)
+
     print(f"First task! #{current_task + 1}: {tasks[current_task]}")
     
-    for update in range(0, num_updates):
+    profiler = None
+    for update in range(start_update, num_updates):
+        if args.profile_window is not None and update == args.profile_window[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            profiler = torch.profiler.profile(
+                activities=activities,
+                record_shapes=True,
+                profile_memory=True,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(f"runs/{run_name}/profile"),
+            )
+            profiler.start()
+            timer.enabled = True
 
-        if (update % args.updates_per_env == 0) and update != 0:
-            test_time = time.time()
-            test(agent, test_envs, tasks, global_step, True, True)
-            print(f"Tested! Time elaplesed {time.time() - test_time}")
-            print()
-            start_time = time.time()
+        # With --concurrent-tasks every task is trained in every update, there is no task switch
+        if not args.concurrent_tasks and (update % args.updates_per_env == 0) and update != 0:
+            eval_time += run_test(global_step, True, True)
 
             current_task += 1
             current_task %= len(tasks)
@@ -806,19 +1166,15 @@ if __name__ == "__main__":
             if args.ewc:
                 ewc.update_task_weights(
                     task_id=tasks[current_task],
-                    obs=torch.Tensor(next_obs).to(device)
+                    obs=torch.Tensor(collector.last_obs).to(device)
                 )
 
-            envs.async_reset()
+            collector.reset(envs)
             # next_done = torch.zeros(batch_size).to(device)
             print(f"Next task! #{current_task + 1}: {tasks[current_task]}")
 
-        if update % 20 == 0 and update % args.updates_per_env != 0:
-            test_time = time.time()
-            test(agent, test_envs, tasks, global_step)
-            print(f"Tested! Time elaplesed {time.time() - test_time}")
-            print()
-            start_time = time.time()
+        if update % args.eval_frequency == 0 and (args.concurrent_tasks or update % args.updates_per_env != 0):
+            eval_time += run_test(global_step)
 
         # Learning rate annealing
         if args.anneal_lr:
@@ -829,67 +1185,30 @@ if __name__ == "__main__":
         episode_rewards = np.zeros(args.num_envs)
         episode_lenghts = np.zeros(args.num_envs)
 
-        episode_step = np.zeros(args.num_envs)
-
-        # Rollout
-        for step in range(args.num_steps):
-            global_step += batch_size
-
-            # Receive state from environments
-            next_obs, reward, term, trunc, info = envs.recv()
-                
-            env_ids = info["env_id"]
-
-            # Store current observation
-            obs[step][env_ids] = torch.Tensor(next_obs).to(device)
-
-            # Get actions
-            with torch.no_grad():
-                action, logprob, _, value = agent.get_action_and_value(obs[step][env_ids])
-                values[step][env_ids] = value.flatten()
+        if args.use_lora and update == 1:
+            # Dopo il primo update gli adapter non sono piu' nulli
+            agent.check_lora_merge(buffer.step_obs(0))
 
-            actions[step][env_ids] = action
-            logprobs[step][env_ids] = logprob
+        # Rollout, with the LoRA adapters merged until the update
+        agent.reset_caches()
+        broadcast_buffers(agent)
+        with agent.merged_lora():
+            global_step += collector.collect(agent) * world_size
 
-            # Store rewards and dones
-            rewards[step][env_ids] = torch.tensor(reward).to(device)
-            dones[step][env_ids] = torch.tensor(term | trunc).to(device)
-
-            # Send actions to environments
-            envs.send(action.cpu().numpy(), env_ids)
-            episode_step[env_ids] += 1
+            with timer.phase("policy_forward"), torch.no_grad():
+                last_slots = (args.num_steps - 1) * args.num_envs + np.arange(args.num_envs)
+                next_value = agent.get_value(buffer.step_obs(-1), slots=last_slots).reshape(1, -1)
 
         # Advantage computation
-        with torch.no_grad():
-
-            next_value = agent.get_value(obs[-1]).reshape(1, -1)
+        with timer.phase("gae"), torch.no_grad():
             if args.gae:
-                advantages = torch.zeros_like(rewards).to(device)
-                lastgaelam = 0
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = ~ dones[-1]
-                        nextvalues = next_value
-                    else:
-                        nextnonterminal = ~ dones[t + 1]
-                        nextvalues = values[t + 1]
-                    delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                    advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-                returns = advantages + values
+                advantages, returns = compute_gae(rewards, values, dones, next_value, args.gamma, args.gae_lambda,
+                                                  method=args.gae_method)
             else:
-                returns = torch.zeros_like(rewards).to(device)
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = ~ dones[-1]
-                        next_return = next_value
-                    else:
-                        nextnonterminal = ~ dones[t + 1]
-                        next_return = returns[t + 1]
-                    returns[t] = rewards[t] + args.gamma * nextnonterminal * next_return
-                advantages = returns - values
+                advantages, returns = compute_returns(rewards, values, dones, next_value, args.gamma,
+                                                      method=args.gae_method)
 
         # Flatten batch
-        b_obs = obs.reshape((-1,) + envs.observation_space.shape)
         b_logprobs = logprobs.reshape(-1)
         b_actions = actions.reshape((-1,) + envs.action_space.shape)
         b_advantages = advantages.reshape(-1)
@@ -905,58 +1224,91 @@ if __name__ == "__main__":
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 mb_inds = b_inds[start:end]
-                
 
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(
-                    b_obs[mb_inds], b_actions.long()[mb_inds]
-                )
-                logratio = newlogprob - b_logprobs[mb_inds]
-                ratio = logratio.exp()
+                # Advantages are normalized over the whole minibatch, not per micro-batch, and over the minibatches of all the ranks
+                mb_advantages = b_advantages[mb_inds]
+                if args.norm_adv:
+                    adv_mean, adv_std = global_mean_std(mb_advantages)
+                    mb_advantages = (mb_advantages - adv_mean) / (adv_std + 1e-8)
 
+                # Gradient accumulation: the loss of each micro-batch is weighted by its share of the minibatch
+                optimizer.zero_grad()
+                mb_logratio = []
+                pg_loss, v_loss, entropy_loss = 0.0, 0.0, 0.0
+                for micro_start, micro_end in micro_batches(mb_inds, micro_batch_size):
+                    u_inds = mb_inds[micro_start:micro_end]
+                    u_advantages = mb_advantages[micro_start:micro_end]
+                    weight = len(u_inds) / len(mb_inds)
+
+                    with timer.phase("minibatch_forward"):
+                        if args.freeze_backbone:
+                            # Il backbone congelato non cambia: le feature salvate nel rollout sono riusate
+                            _, newlogprob, entropy, newvalue = agent.heads(buffer.flat_features(u_inds), b_actions.long()[u_inds])
+                        else:
+                            _, newlogprob, entropy, newvalue = agent.get_action_and_value(
+                                buffer.flat_obs(u_inds), b_actions.long()[u_inds], slots=u_inds
+                            )
+                        logratio = newlogprob - b_logprobs[u_inds]
+                        ratio = logratio.exp()
+                        mb_logratio.append(logratio.detach())
+
+                        # Policy loss
+                        pg_loss1 = -u_advantages * ratio
+                        pg_loss2 = -u_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
+                        u_pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+
+                        # Value loss
+                        newvalue = newvalue.view(-1)
+                        if args.clip_vloss:
+                            v_loss_unclipped = (newvalue - b_returns[u_inds]) ** 2
+                            v_clipped = b_values[u_inds] + torch.clamp(
+                                newvalue - b_values[u_inds],
+                                -args.clip_coef,
+                                args.clip_coef,
+                            )
+                            v_loss_clipped = (v_clipped - b_returns[u_inds]) ** 2
+                            v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+                            u_v_loss = 0.5 * v_loss_max.mean()
+                        else:
+                            u_v_loss = 0.5 * ((newvalue - b_returns[u_inds]) ** 2).mean()
+
+                        u_entropy_loss = entropy.mean()
+                        loss = u_pg_loss - args.ent_coef * u_entropy_loss + u_v_loss * args.vf_coef
+
+                    with timer.phase("minibatch_backward"):
+                        scaler.scale(loss * weight).backward()
+
+                    pg_loss += u_pg_loss.detach() * weight
+                    v_loss += u_v_loss.detach() * weight
+                    entropy_loss += u_entropy_loss.detach() * weight
+
+                logratio = torch.cat(mb_logratio)
+                ratio = logratio.exp()
                 with torch.no_grad():
                     old_approx_kl = (-logratio).mean()
                     approx_kl = ((ratio - 1) - logratio).mean()
                     clipfracs += [((ratio - 1.0).abs() > args.clip_coef).float().mean().item()]
 
-                mb_advantages = b_advantages[mb_inds]
-                if args.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                # Value loss
-                newvalue = newvalue.view(-1)
-                if args.clip_vloss:
-                    v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                    v_clipped = b_values[mb_inds] + torch.clamp(
-                        newvalue - b_values[mb_inds],
-                        -args.clip_coef,
-                        args.clip_coef,
-                    )
-                    v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
-
-                entropy_loss = entropy.mean()
-                loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
-
                 if args.ewc:
                     ewc_loss = ewc.compute_ewc_loss()
-                    loss += ewc_loss
+                    scaler.scale(ewc_loss).backward()
 
-                optimizer.zero_grad()
-                loss.backward()
-                nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
-                optimizer.step()
+                if world_size > 1:
+                    with timer.phase("grad_allreduce"):
+                        all_reduce_gradients(agent)
+
+                with timer.phase("optimizer_step"):
+                    scaler.unscale_(optimizer)
+                    nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
+                    scaler.step(optimizer)
+                    scaler.update()
                 if args.s_p:
                     shrink_perturb(agent)
+                    # The perturbation is random, every rank takes the one of rank 0
+                    broadcast_state(agent)
                     
-            if args.target_kl is not None and approx_kl > args.target_kl:
+            # Every rank must stop at the same epoch
+            if args.target_kl is not None and global_mean(approx_kl) > args.target_kl:
                 break
 
         # Log training metrics
@@ -974,10 +1326,34 @@ if __name__ == "__main__":
         writer.add_scalar("losses/approx_kl", approx_kl.item(), global_step)
         writer.add_scalar("losses/clipfrac", np.mean(clipfracs), global_step)
         writer.add_scalar("losses/explained_variance", explained_var, global_step)
+        if args.concurrent_tasks:
+            # Mean reward per step of the envs of each task in this rollout
+            task_rewards = torch.zeros(len(tasks), device=device).index_add_(0, buffer.task_ids, rewards.sum(dim=0))
+            for i, task in enumerate(tasks):
+                writer.add_scalar(f"{task}/rollout_reward", task_rewards[i].item() / (task_num_envs * args.num_steps), global_step)
         # print("SPS:", int(global_step / (time.time() - start_time)))
-        writer.add_scalar("charts/SPS", int(global_step / (time.time() - start_time)), global_step)
-
-    test(agent, test_envs, tasks, global_step, True, True)
+        if agent.embedding_cache is not None:
+            writer.add_scalar("charts/embedding_cache_saved_gflops", agent.embedding_cache.saved_flops() / 1e9, global_step)
+        writer.add_scalar("charts/SPS", int(global_step / (time.time() - start_time - eval_time)), global_step)
+        if timer.enabled:
+            print(f"Phases: {timer.report()}")
+            timer.log(writer, global_step)
+        if profiler is not None and update == args.profile_window[1]:
+            profiler.stop()
+            profiler = None
+            timer.enabled = args.profile_phases
+            print(f"Profiler trace saved in runs/{run_name}/profile")
+        if args.checkpoint_frequency > 0 and (update + 1) % args.checkpoint_frequency == 0:
+            save_checkpoint(update + 1)
+        log_worker_results()
+
+    if profiler is not None:
+        profiler.stop()
+    checkpoint_writer.close()
+    run_test(global_step, True, True)
+    if eval_worker is not None:
+        log_worker_results(block=True)
+        eval_worker.close()
     '''
     # columns = [f"Task {i}" for i in range(results_matrix.shape[0])]
     results_matrix_20 = (results_matrix - 3.5) / 16.5
@@ -1033,5 +1409,8 @@ if __name__ == "__main__":
     for test_env in test_envs:
         test_env.close()
         
-    os.makedirs("models", exist_ok=True)
-    torch.save(agent, f"models/{args.exp_name}.pth")
+    if is_main:
+        os.makedirs("models", exist_ok=True)
+        torch.save(agent, f"models/{args.exp_name}.pth")
+    if world_size > 1:
+        torch.distributed.destroy_process_group()
@@ -0,0 +1,72 @@
+import functools
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from feature_cache import SlotCache
+
+
+def _select_resize(obs, num_channels, size):
+    if num_channels > 0:
+        obs = obs[:, -num_channels:]
+    if size is not None:
+        obs = F.interpolate(obs, size=size, mode="nearest")
+    return obs
+
+
+def _select_resize_scale(obs, num_channels, size, scale):
+    # Channels are selected and resized while still uint8, the float tensor is only created at the output size
+    obs = _select_resize(obs, num_channels, size).float()
+    return obs / 255.0 if scale else obs
+
+
+@functools.cache
+def _compiled_select_resize_scale():
+    # Built on first use and kept out of the module, so the Agent can still be pickled
+    # The batch is marked dynamic in forward(), its size changes between rollout, update and evaluation
+    return torch.compile(_select_resize_scale, dynamic=None)
+
+
+class InputPreprocessor(nn.Module):
+    """
+    Turns the uint8 observations into the input of the backbone in one pass.
+
+    Selects the last num_channels channels (all if 0), resizes them with nearest
+    interpolation and converts them to float, dividing by 255 if scale is True.
+    Nearest interpolation only moves pixels, so it runs on the uint8 frames and the
+    result matches resizing the float frames. With compile the pass is built with
+    torch.compile, which fuses the gather, the cast and the division in one kernel.
+
+    enable_cache() keeps the resized uint8 frames by rollout slot, so the update
+    epochs only pay for the cast.
+
+    Args:
+        num_channels: number of trailing channels used by the network, 0 for all
+        size: (H, W) the frames are resized to, None to keep the env resolution
+        scale: if True the output is in [0, 1], otherwise in [0, 255]
+        compile: if True the pass is compiled with torch.compile
+    """
+
+    def __init__(self, num_channels=0, size=None, scale=True, compile=False):
+        super().__init__()
+        self.num_channels = num_channels
+        self.size = tuple(size) if size is not None else None
+        self.scale = scale
+        self.cache = None
+        self.compile = compile
+
+    def enable_cache(self, num_slots, device):
+        """Caches the resized frames of the rollout, only useful if the frames are resized."""
+        if self.size is not None:
+            self.cache = SlotCache(num_slots, device)
+
+    def forward(self, obs, slots=None):
+        fn = _select_resize_scale
+        if self.compile:
+            fn = _compiled_select_resize_scale()
+            torch._dynamo.maybe_mark_dynamic(obs, 0)
+        if self.cache is not None and slots is not None and not obs.is_floating_point():
+            resized = self.cache.lookup(slots, lambda: _select_resize(obs, self.num_channels, self.size))
+            return fn(resized, 0, None, self.scale)
+        return fn(obs, self.num_channels, self.size, self.scale)
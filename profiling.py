@@ -0,0 +1,82 @@
+import contextlib
+import time
+
+import psutil
+import torch
+
+
+class PhaseTimer:
+    """
+    Wall time and memory of the phases of the training loop.
+
+    phase(name) is a context manager that adds the time spent in the block to the
+    phase and labels it with record_function, so the phases also show up in a
+    torch.profiler trace. On CUDA the device is synchronized at the start and end of
+    each phase, so the asynchronous kernels are charged to the phase that issued them
+    (this removes the overlap between phases, keep it off for normal runs), and the
+    memory is the peak allocated memory during the phase. On CPU the peak resident
+    memory cannot be reset, so the resident memory is sampled at the start and end of
+    the phase instead: rss is the resident memory at the end of the phase and
+    rss_delta its growth during the phase, the memory of the phase is CUDA-only.
+    log() writes the totals accumulated since the last call to the SummaryWriter and
+    resets them.
+
+    Args:
+        device: device of the training loop
+        enabled: if False phase() does nothing
+    """
+
+    def __init__(self, device, enabled=True):
+        self.device = device
+        self.enabled = enabled
+        self.process = psutil.Process()
+        self.times = {}
+        self.memory = {}
+        self.rss = {}
+        self.rss_delta = {}
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _rss(self):
+        return self.process.memory_info().rss / 1024**2
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            start_rss = self._rss()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        self._sync()
+        self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+        if self.device.type == "cuda":
+            self.memory[name] = max(self.memory.get(name, 0.0), torch.cuda.max_memory_allocated(self.device) / 1024**2)
+        else:
+            rss = self._rss()
+            self.rss[name] = max(self.rss.get(name, 0.0), rss)
+            self.rss_delta[name] = max(self.rss_delta.get(name, float("-inf")), rss - start_rss)
+
+    def log(self, writer, global_step):
+        """Writes time, share of the total time and memory of every phase, then resets them."""
+        total = sum(self.times.values())
+        for name, elapsed in self.times.items():
+            writer.add_scalar(f"perf/{name}_time", elapsed, global_step)
+            writer.add_scalar(f"perf/{name}_fraction", elapsed / total if total > 0 else 0.0, global_step)
+            if name in self.memory:
+                writer.add_scalar(f"perf/{name}_memory_mb", self.memory[name], global_step)
+            if name in self.rss:
+                writer.add_scalar(f"perf/{name}_rss_mb", self.rss[name], global_step)
+                writer.add_scalar(f"perf/{name}_rss_delta_mb", self.rss_delta[name], global_step)
+        self.times, self.memory, self.rss, self.rss_delta = {}, {}, {}, {}
+
+    def report(self):
+        total = sum(self.times.values())
+        return ", ".join(f"{name} = {elapsed:.2f}s ({100 * elapsed / total:.0f}%)" for name, elapsed in self.times.items())
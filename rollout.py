@@ -0,0 +1,156 @@
+import numpy as np
+import torch
+
+from profiling import PhaseTimer
+
+
+class RolloutCollector:
+    """
+    Fills a RolloutBuffer through envpool's async_reset/recv/send API.
+
+    With batch_size == num_envs every recv() returns all the envs and this is the
+    synchronous rollout. With a smaller batch_size recv() returns the first envs
+    that finished stepping, so the policy runs on one batch of envs while the
+    others are still being simulated. Every env keeps its own step counter into
+    the step-major buffer.
+
+    recv() only returns once batch_size envs are ready, so every env must stay in
+    flight until the rollout ends: envs whose column is already full keep getting
+    actions. Their whole transition (observation, reward, done, action, logprob,
+    value) is kept and stored at the start of the next rollout, the action of a
+    carried transition comes from the policy before the update, like the one of
+    any transition of the rollout it ends up in. At most num_steps transitions per
+    env are carried, so they all fit in the next rollout: the later ones of an env
+    that runs ahead are dropped, and the next transition kept for it is marked done
+    so the advantages are not bootstrapped across the gap.
+
+    Args:
+        envs: envpool environment
+        buffer: RolloutBuffer to fill
+        transfer: HostToDevice used for rewards and dones
+        obs_channels: slice of the observation channels to store
+        timer: PhaseTimer for the env_recv, h2d, policy_forward and env_send phases
+    """
+
+    def __init__(self, envs, buffer, transfer, obs_channels, timer=None):
+        self.envs = envs
+        self.buffer = buffer
+        self.transfer = transfer
+        self.obs_channels = obs_channels
+        self.timer = timer if timer is not None else PhaseTimer(buffer.device, enabled=False)
+        self.carried = []
+        self.num_carried = np.zeros(buffer.num_envs, dtype=np.int64)
+        self.dropped = np.zeros(buffer.num_envs, dtype=bool)
+        self.last_obs = None
+
+    def reset(self, envs=None):
+        """Resets the envs (or switches to new ones) and drops the carried transitions."""
+        if envs is not None:
+            self.envs = envs
+        self.carried = []
+        self.num_carried[:] = 0
+        self.dropped[:] = False
+        self.envs.async_reset()
+
+    def _recv(self):
+        next_obs, reward, term, trunc, info = self.envs.recv()
+        self.last_obs = next_obs
+        return info["env_id"], next_obs[:, self.obs_channels], reward, term | trunc
+
+    def _store(self, steps, env_ids, obs, reward, done, action, logprob, value, hidden):
+        """Stores a carried transition at the given steps."""
+        buffer = self.buffer
+        device = buffer.device
+        buffer.store_obs(steps, env_ids, obs)
+        buffer.actions[steps, env_ids] = action
+        buffer.logprobs[steps, env_ids] = logprob
+        buffer.values[steps, env_ids] = value
+        if buffer.features is not None:
+            buffer.features[steps, env_ids] = hidden
+        buffer.rewards[steps, env_ids] = torch.as_tensor(reward, device=device)
+        buffer.store_dones(steps, env_ids, done, torch.as_tensor(done, device=device))
+
+    def collect(self, agent):
+        """Runs one rollout of buffer.num_steps steps per env, returns the number of env steps."""
+        buffer = self.buffer
+        num_steps = buffer.num_steps
+        env_step = np.zeros(buffer.num_envs, dtype=np.int64)
+        num_transitions = 0
+
+        timer = self.timer
+        buffer.reset()
+
+        # Transitions of the end of the previous rollout, in the order they were received, all of them fit
+        carried, self.carried = self.carried, []
+        self.num_carried[:] = 0
+        with timer.phase("h2d"):
+            for transition in carried:
+                env_ids = transition[0]
+                self._store(env_step[env_ids], *transition)
+                env_step[env_ids] += 1
+                num_transitions += len(env_ids)
+
+        while env_step.min() < num_steps:
+            with timer.phase("env_recv"):
+                env_ids, next_obs, reward, next_done = self._recv()
+
+            # Envs that already filled their column keep stepping, their transition goes to the next rollout
+            full = env_step[env_ids] >= num_steps
+            if full.any():
+                with timer.phase("policy_forward"), torch.no_grad():
+                    full_obs = torch.from_numpy(np.ascontiguousarray(next_obs[full])).to(buffer.device)
+                    hidden = agent.encode(full_obs)
+                    action, logprob, _, value = agent.heads(hidden)
+                # One rollout per env at most, the first transition kept after a drop starts a new trajectory
+                full_ids = env_ids[full]
+                keep = self.num_carried[full_ids] < num_steps
+                self.dropped[full_ids[~keep]] = True
+                if keep.any():
+                    kept_ids = full_ids[keep]
+                    self.carried.append((
+                        kept_ids, next_obs[full][keep].copy(), reward[full][keep].copy(),
+                        next_done[full][keep] | self.dropped[kept_ids], action[keep], logprob[keep], value.flatten()[keep],
+                        hidden[keep] if buffer.features is not None else None,
+                    ))
+                    self.num_carried[kept_ids] += 1
+                    self.dropped[kept_ids] = False
+                with timer.phase("env_send"):
+                    self.envs.send(action.cpu().numpy(), env_ids[full])
+                env_ids, next_obs, reward, next_done = env_ids[~full], next_obs[~full], reward[~full], next_done[~full]
+                if len(env_ids) == 0:
+                    continue
+            steps = env_step[env_ids]
+
+            # Store current observation
+            with timer.phase("h2d"):
+                buffer.store_obs(steps, env_ids, next_obs)
+
+                # Rewards and dones are copied while the policy runs
+                reward_tensor = self.transfer.copy("reward", reward)
+                done_tensor = self.transfer.copy("done", next_done)
+
+            # Get actions
+            with timer.phase("policy_forward"), torch.no_grad():
+                slots = steps * buffer.num_envs + env_ids
+                hidden = agent.encode(buffer.step_obs(steps, env_ids), slots=slots)
+                action, logprob, _, value = agent.heads(hidden)
+                buffer.values[steps, env_ids] = value.flatten()
+                if buffer.features is not None:
+                    buffer.features[steps, env_ids] = hidden
+
+            buffer.actions[steps, env_ids] = action
+            buffer.logprobs[steps, env_ids] = logprob
+
+            # Store rewards and dones
+            with timer.phase("h2d"):
+                self.transfer.wait()
+                buffer.rewards[steps, env_ids] = reward_tensor
+                buffer.store_dones(steps, env_ids, next_done, done_tensor)
+
+            # Send actions to environments
+            with timer.phase("env_send"):
+                self.envs.send(action.cpu().numpy(), env_ids)
+            env_step[env_ids] += 1
+            num_transitions += len(env_ids)
+
+        return num_transitions
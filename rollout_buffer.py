@@ -0,0 +1,198 @@
+import numpy as np
+import torch
+
+from transfer import HostToDevice
+
+
+class RolloutBuffer:
+    """
+    On-device storage for one PPO rollout.
+
+    Observations are stored as uint8 (the raw envpool frames), the conversion to
+    float happens per minibatch in Agent.preprocess (InputPreprocessor). With
+    12x120x160 frames this takes 1/4 of the memory of the old float32 storage.
+
+    Two storage modes are available for the observations:
+        dense: every step stores the full stack of frames (num_steps, num_envs, C, H, W)
+        frame_ring: every frame is stored once in a shared pool and the stacks are
+            rebuilt on demand from a (num_steps, num_envs, num_frames) index table.
+            Consecutive stacks of the same env share num_frames - 1 frames, so only
+            the newest frame is transferred and stored, unless the env has just been
+            reset (or the rollout has just started) and the whole stack is new.
+
+    Args:
+        num_steps: number of steps per rollout
+        num_envs: number of parallel environments
+        obs_shape: shape of a single observation (C, H, W)
+        device: device where the storage lives
+        storage: "dense" or "frame_ring"
+        num_frames: number of stacked frames in an observation
+        transfer: HostToDevice used for the observation copies, one is created if None
+        feature_dim: if > 0, the backbone features of every step are stored too (frozen backbone)
+        task_ids: task of every env when the envs of several tasks share the rollout, all 0 if None
+    """
+
+    def __init__(self, num_steps, num_envs, obs_shape, device, storage="dense", num_frames=4, transfer=None, feature_dim=0,
+                 task_ids=None):
+        self.num_steps = num_steps
+        self.num_envs = num_envs
+        self.obs_shape = tuple(obs_shape)
+        self.device = device
+        self.transfer = transfer if transfer is not None else HostToDevice(device)
+        self.storage = storage
+        self.num_frames = num_frames
+
+        match self.storage:
+            case "dense":
+                self.obs = torch.zeros((num_steps, num_envs) + self.obs_shape, dtype=torch.uint8, device=device)
+            case "frame_ring":
+                c, h, w = self.obs_shape
+                self.frame_shape = (c // num_frames, h, w)
+                # One stack per env at the start of the rollout plus one full stack per env for resets,
+                # the pool grows if the envs are reset more often than that
+                capacity = (num_steps + 2 * (num_frames - 1)) * num_envs
+                self.frames = torch.zeros((capacity,) + self.frame_shape, dtype=torch.uint8, device=device)
+                self.stack_index = torch.zeros((num_steps, num_envs, num_frames), dtype=torch.int64, device=device)
+                self._last_index = np.zeros((num_envs, num_frames), dtype=np.int64)
+                self._has_history = np.zeros(num_envs, dtype=bool)
+                self._free = 0
+            case default:
+                raise ValueError(f"Unknown observation storage: {self.storage}")
+
+        self.actions = torch.zeros((num_steps, num_envs), dtype=torch.int64, device=device)
+        self.logprobs = torch.zeros((num_steps, num_envs), device=device)
+        self.rewards = torch.zeros((num_steps, num_envs), device=device)
+        self.dones = torch.zeros((num_steps, num_envs), dtype=torch.bool, device=device)
+        self.values = torch.zeros((num_steps, num_envs), device=device)
+        self.features = torch.zeros((num_steps, num_envs, feature_dim), device=device) if feature_dim > 0 else None
+        # Every env column belongs to one task for the whole rollout
+        task_ids = np.zeros(num_envs, dtype=np.int64) if task_ids is None else np.asarray(task_ids, dtype=np.int64)
+        self.task_ids = torch.as_tensor(task_ids, device=device)
+
+    def reset(self):
+        """Starts a new rollout, the frames of the previous one are released."""
+        if self.storage == "frame_ring":
+            self._free = 0
+            self._has_history[:] = False
+
+    def use_storage(self, tensors):
+        """
+        Makes the next rollouts write into the given tensors (e.g. a slot of a TrajectoryQueue) instead of
+        the buffer's own, only with the dense storage. tensors maps attribute names (obs, actions, ...) to
+        tensors of the same shape and dtype.
+        """
+        if self.storage != "dense":
+            raise ValueError("External storage needs the dense observation storage")
+        for name, tensor in tensors.items():
+            if tensor.shape != getattr(self, name).shape:
+                raise ValueError(f"{name}: expected shape {tuple(getattr(self, name).shape)}, got {tuple(tensor.shape)}")
+            setattr(self, name, tensor)
+
+    def store_obs(self, step, env_ids, next_obs):
+        """
+        Stores the observations received from envs.recv() for the given envs.
+        step is either a single step or an array with the step of each env.
+        """
+        if self.storage == "dense":
+            self.obs[step, env_ids] = self._to_device("obs", next_obs)
+            return
+
+        env_ids = np.asarray(env_ids)
+        next_obs = np.asarray(next_obs)
+        num_frames = self.num_frames
+        c = self.frame_shape[0]
+
+        cont = self._has_history[env_ids]
+        num_cont = int(cont.sum())
+        num_full = len(env_ids) - num_cont
+        start = self._reserve(num_cont + num_full * num_frames)
+
+        # Continuing envs only bring their newest frame, the others the whole stack
+        new_frames = np.concatenate([
+            next_obs[cont, -c:],
+            next_obs[~cont].reshape((-1,) + self.frame_shape),
+        ])
+        self.frames[start:start + len(new_frames)] = self._to_device("frames", new_frames)
+
+        rows = np.empty((len(env_ids), num_frames), dtype=np.int64)
+        rows[cont, :-1] = self._last_index[env_ids[cont], 1:]
+        rows[cont, -1] = start + np.arange(num_cont)
+        rows[~cont] = start + num_cont + np.arange(num_full * num_frames).reshape(num_full, num_frames)
+
+        self.stack_index[step, env_ids] = self._to_device("stack_index", rows)
+        self._last_index[env_ids] = rows
+        self._has_history[env_ids] = True
+
+    def store_dones(self, step, env_ids, done, done_tensor=None):
+        """
+        Stores the done flags, a done env starts a new stack at its next observation.
+        done_tensor is an already issued device copy of done, if any.
+        """
+        self.dones[step, env_ids] = done_tensor if done_tensor is not None else self._to_device("dones", done)
+        if self.storage == "frame_ring":
+            self._has_history[np.asarray(env_ids)[np.asarray(done)]] = False
+
+    def step_obs(self, step, env_ids=None):
+        """Returns the stacked observations stored at a step, for all envs if env_ids is None."""
+        if self.storage == "dense":
+            return self.obs[step] if env_ids is None else self.obs[step, env_ids]
+        index = self.stack_index[step] if env_ids is None else self.stack_index[step, env_ids]
+        return self._stack(index)
+
+    def flat_obs(self, inds):
+        """Returns the stacked observations for indices into the flattened (num_steps * num_envs) batch."""
+        if self.storage == "dense":
+            return self.obs.reshape((-1,) + self.obs_shape)[inds]
+        return self._stack(self.stack_index.reshape(-1, self.num_frames)[inds])
+
+    def flat_features(self, inds):
+        """Returns the stored backbone features for indices into the flattened (num_steps * num_envs) batch."""
+        return self.features.reshape(-1, self.features.shape[-1])[inds]
+
+    def _to_device(self, name, array):
+        tensor = self.transfer.copy(name, array)
+        self.transfer.wait()
+        return tensor
+
+    def _stack(self, index):
+        frames = self.frames[index]  # (..., num_frames, 3, H, W)
+        return frames.reshape(index.shape[:-1] + self.obs_shape)
+
+    def _reserve(self, num):
+        start = self._free
+        if start + num > self.frames.shape[0]:
+            capacity = max(2 * self.frames.shape[0], start + num)
+            frames = torch.zeros((capacity,) + self.frame_shape, dtype=torch.uint8, device=self.device)
+            frames[:start] = self.frames[:start]
+            self.frames = frames
+        self._free = start + num
+        return start
+
+    def tensors(self):
+        if self.storage == "dense":
+            observations = {"obs": self.obs}
+        else:
+            observations = {"frames": self.frames, "stack_index": self.stack_index}
+        if self.features is not None:
+            observations["features"] = self.features
+        return {
+            **observations,
+            "actions": self.actions,
+            "logprobs": self.logprobs,
+            "rewards": self.rewards,
+            "dones": self.dones,
+            "values": self.values,
+            "task_ids": self.task_ids,
+        }
+
+    def memory_bytes(self):
+        """Returns the number of bytes used by each stored tensor."""
+        return {name: t.element_size() * t.nelement() for name, t in self.tensors().items()}
+
+    def memory_footprint(self):
+        """Returns the total memory used by the buffer in MB."""
+        return sum(self.memory_bytes().values()) / 1024**2
+
+    def report(self):
+        sizes = ", ".join(f"{name} = {size / 1024**2:.2f} MB" for name, size in self.memory_bytes().items())
+        return f"Rollout buffer ({self.storage}): Totale = {self.memory_footprint():.2f} MB ({sizes})"
@@ -8,7 +8,7 @@ minibatches=(4 8 16 32)
 
 # Parametri fissi
 base_exp_name="ppo_cnn_1_adapted"
-fixed_args="--track True --seed 1 --network-type cnn --ac-mlp False --pretrained-adapt True"
+fixed_args="--track True --seed 1 --network-type cnn --ac-mlp False --pretrained-adapt True --compile-policy True"
 
 # Itera su ogni combinazione
 for lr in "${learning_rates[@]}"; do
@@ -0,0 +1,109 @@
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Returns a copy of obj with every tensor copied to CPU and every numpy array copied, nested dicts, lists and tuples included."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def model_state(model, trainable_only=False):
+    """
+    state_dict of model. With trainable_only (LoRA runs) the frozen parameters are left out,
+    the buffers are kept since training updates them (BatchNorm running stats).
+    """
+    state = model.state_dict()
+    if not trainable_only:
+        return state
+    frozen = {name for name, param in model.named_parameters() if not param.requires_grad}
+    return {name: value for name, value in state.items() if name not in frozen}
+
+
+def load_model_state(model, state, trainable_only=False):
+    """
+    Loads a state saved by model_state. With trainable_only only the frozen parameters may be
+    missing, anything else missing or unexpected means the checkpoint is of another model.
+    """
+    if not trainable_only:
+        model.load_state_dict(state)
+        return
+    missing, unexpected = model.load_state_dict(state, strict=False)
+    frozen = {name for name, param in model.named_parameters() if not param.requires_grad}
+    missing = [name for name in missing if name not in frozen]
+    if missing or unexpected:
+        raise RuntimeError(f"Checkpoint does not match the model: missing keys {missing}, unexpected keys {unexpected}")
+
+
+def rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints with torch.save in a background thread.
+
+    save() takes a CPU snapshot of the state on the calling thread, the training loop
+    can then modify the model, the optimizer and the arrays of the state while the
+    file is written. Only one
+    write is in flight: a new save() first waits for the previous one. Files are
+    written to a temporary path and renamed, so a crash never leaves a truncated
+    checkpoint behind.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def save(self, state, path):
+        state = snapshot(state)
+        self.wait()
+        self.future = self.executor.submit(_write, state, path)
+
+    def wait(self):
+        """Waits for the write in flight, if any, and raises its error."""
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def _write(state, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    # The RNG states are python and numpy objects, not only tensors
+    return torch.load(path, map_location="cpu", weights_only=False)
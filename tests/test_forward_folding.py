@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from benchmarking import use_random_weights
+from main import Agent, parse_args
+
+
+@pytest.fixture(autouse=True)
+def random_weights(monkeypatch):
+    use_random_weights(monkeypatch.setattr)
+
+
+def make_agent(network_type, forward_type, pretrained_adapt=False):
+    torch.manual_seed(0)
+    agent = Agent((12, 120, 160), 12, network_type=network_type, forward_type=forward_type,
+                  pretrained_adapt=pretrained_adapt, args=parse_args([]))
+    return agent.eval()
+
+
+def random_obs(batch_size=2):
+    generator = torch.Generator().manual_seed(1)
+    return torch.randint(0, 256, (batch_size, 12, 120, 160), dtype=torch.uint8, generator=generator)
+
+
+def per_frame_avg(agent, x):
+    """The multi_frame_avg forward before the frames were folded into the batch: one backbone call per frame."""
+    bs, c, h, w = x.shape
+    frames = x.view(bs, 4, c // 4, h, w)
+    outputs = [agent.network(frames[:, i]) for i in range(4)]
+    return torch.stack(outputs, dim=0).mean(dim=0)
+
+
+def per_frame_patch_concat(agent, x):
+    """The multi_frame_patch_concat forward before the frames were folded into the batch: one embedding call per frame."""
+    bs, c, h, w = x.shape
+    frames = x.view(bs, 4, c // 4, h, w)
+    swin = agent.network.swin
+    patches = torch.cat([swin.embeddings(frames[:, i])[0] for i in range(4)], dim=1)
+    outputs = swin.encoder(patches, input_dimensions=(h, int(w / 4)))
+    outputs = swin.layernorm(outputs.last_hidden_state)
+    pooled_output = torch.flatten(swin.pooler(outputs.transpose(1, 2)), 1)
+    return agent.network.classifier(pooled_output)
+
+
+@pytest.mark.parametrize("network_type", ["resnet_s", "swin_s"])
+def test_multi_frame_avg_matches_per_frame_loop(network_type):
+    agent = make_agent(network_type, "multi_frame_avg")
+    with torch.no_grad():
+        x = agent.preprocess(random_obs())
+        torch.testing.assert_close(agent.forward_backbone(x), per_frame_avg(agent, x))
+
+
+def test_multi_frame_patch_concat_matches_per_frame_loop():
+    agent = make_agent("swin_w_hf", "multi_frame_patch_concat", pretrained_adapt=True)
+    with torch.no_grad():
+        x = agent.preprocess(random_obs())
+        torch.testing.assert_close(agent.forward_backbone(x), per_frame_patch_concat(agent, x))
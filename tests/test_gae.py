@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from bench_gae import loop_gae, loop_returns
+from gae import compute_gae, compute_returns
+
+
+def random_rollout(num_steps, num_envs, done_prob):
+    generator = torch.Generator().manual_seed(0)
+    rewards = torch.randn(num_steps, num_envs, generator=generator)
+    values = torch.randn(num_steps, num_envs, generator=generator)
+    dones = torch.rand(num_steps, num_envs, generator=generator) < done_prob
+    dones[-1, 0] = True  # the bootstrap of the last step is masked with its own done flag
+    next_value = torch.randn(1, num_envs, generator=generator)
+    return rewards, values, dones, next_value
+
+
+@pytest.mark.parametrize("method,chunk_size", [("script", 16), ("chunked", 16), ("chunked", 7)])
+@pytest.mark.parametrize("done_prob", [0.0, 0.1, 0.5])
+def test_compute_gae_matches_loop(method, chunk_size, done_prob):
+    rewards, values, dones, next_value = random_rollout(50, 6, done_prob)
+    advantages, returns = compute_gae(rewards, values, dones, next_value, 0.99, 0.95, method=method, chunk_size=chunk_size)
+    expected_advantages, expected_returns = loop_gae(rewards, values, dones, next_value, 0.99, 0.95)
+    torch.testing.assert_close(advantages, expected_advantages)
+    torch.testing.assert_close(returns, expected_returns)
+
+
+@pytest.mark.parametrize("method,chunk_size", [("script", 16), ("chunked", 16), ("chunked", 7)])
+@pytest.mark.parametrize("done_prob", [0.0, 0.1, 0.5])
+def test_compute_returns_matches_loop(method, chunk_size, done_prob):
+    rewards, values, dones, next_value = random_rollout(50, 6, done_prob)
+    advantages, returns = compute_returns(rewards, values, dones, next_value, 0.99, method=method, chunk_size=chunk_size)
+    expected_advantages, expected_returns = loop_returns(rewards, values, dones, next_value, 0.99)
+    torch.testing.assert_close(advantages, expected_advantages)
+    torch.testing.assert_close(returns, expected_returns)
@@ -0,0 +1,21 @@
+import pytest
+
+from benchmarking import use_random_weights
+from main import Agent, parse_args
+
+
+@pytest.fixture(autouse=True)
+def random_weights(monkeypatch):
+    use_random_weights(monkeypatch.setattr)
+
+
+def test_swin_w_lora_trains_only_the_adapters_and_the_head():
+    agent = Agent((12, 120, 160), 12, network_type="swin_w", forward_type="conv_adapter", use_lora=True,
+                  args=parse_args([]))
+    network = agent.network
+    trainable = {name for name, param in network.named_parameters() if param.requires_grad}
+    expected = {name for name, _ in network.named_parameters() if "lora_" in name}
+    expected |= {f"head.{name}" for name, _ in network.head.named_parameters()}
+    assert trainable == expected
+    assert sum(param.numel() for param in network.parameters() if param.requires_grad) == sum(
+        param.numel() for name, param in network.named_parameters() if name in expected)
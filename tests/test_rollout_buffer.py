@@ -0,0 +1,77 @@
+import numpy as np
+import torch
+
+from env_backend import SyntheticVizDoomEnv
+from rollout import RolloutCollector
+from rollout_buffer import RolloutBuffer
+from transfer import HostToDevice
+
+
+class AttackAgent:
+    """Stand-in policy that always attacks, the value is the mean of the observation."""
+
+    def encode(self, obs, slots=None):
+        return obs.float().flatten(1).mean(dim=1, keepdim=True)
+
+    def heads(self, hidden):
+        action = torch.ones(len(hidden), dtype=torch.int64)
+        return action, torch.zeros(len(hidden)), None, hidden
+
+
+def make_collector(storage, num_steps=8, num_envs=4):
+    # Batches of 3 out of 4 envs and short episodes: partial batches, resets and carried transitions
+    envs = SyntheticVizDoomEnv("run_and_gun", num_envs, batch_size=3, max_episode_steps=5)
+    device = torch.device("cpu")
+    transfer = HostToDevice(device)
+    buffer = RolloutBuffer(num_steps, num_envs, envs.observation_space.shape, device, storage=storage, transfer=transfer)
+    collector = RolloutCollector(envs, buffer, transfer, slice(None))
+    collector.reset()
+    return collector
+
+
+def test_frame_ring_matches_dense():
+    agent = AttackAgent()
+    dense, frame_ring = make_collector("dense"), make_collector("frame_ring")
+    num_steps, num_envs = dense.buffer.num_steps, dense.buffer.num_envs
+    inds = np.random.default_rng(0).permutation(num_steps * num_envs)
+
+    for rollout in range(3):
+        dense.collect(agent)
+        frame_ring.collect(agent)
+        assert len(dense.carried) == len(frame_ring.carried)
+        if rollout == 0:
+            assert dense.carried, "the first rollout should leave carried transitions"
+            assert dense.buffer.dones.any(), "the first rollout should contain a reset"
+
+        torch.testing.assert_close(frame_ring.buffer.dones, dense.buffer.dones)
+        for step in range(num_steps):
+            torch.testing.assert_close(frame_ring.buffer.step_obs(step), dense.buffer.step_obs(step), rtol=0, atol=0)
+        env_ids = np.array([2, 0, 3])
+        steps = np.array([1, 5, 7])
+        torch.testing.assert_close(frame_ring.buffer.step_obs(steps, env_ids), dense.buffer.step_obs(steps, env_ids),
+                                   rtol=0, atol=0)
+        torch.testing.assert_close(frame_ring.buffer.flat_obs(inds), dense.buffer.flat_obs(inds), rtol=0, atol=0)
+
+
+def test_carried_transitions_stay_bounded():
+    num_steps, num_envs = 4, 4
+    # Envs 0 and 1 step 10 times faster than 2 and 3, they run ahead every rollout
+    envs = SyntheticVizDoomEnv("run_and_gun", num_envs, batch_size=2, step_time=[1e-4, 1e-4, 1e-3, 1e-3],
+                               num_threads=num_envs)
+    device = torch.device("cpu")
+    transfer = HostToDevice(device)
+    buffer = RolloutBuffer(num_steps, num_envs, envs.observation_space.shape, device, transfer=transfer)
+    collector = RolloutCollector(envs, buffer, transfer, slice(None))
+    collector.reset()
+
+    agent = AttackAgent()
+    gaps = 0
+    for _ in range(20):
+        collector.collect(agent)
+        carried_ids = np.concatenate([transition[0] for transition in collector.carried] + [np.zeros(0, dtype=np.int64)])
+        assert np.bincount(carried_ids, minlength=num_envs).max() <= num_steps
+        assert len(collector.carried) <= num_steps * num_envs
+        gaps += int(buffer.dones.sum())
+    envs.close()
+    # The transitions dropped from the carry leave a done behind
+    assert gaps > 0
@@ -0,0 +1,90 @@
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+
+# Ownership of a slot
+FREE, WRITING, READY, READING = 0, 1, 2, 3
+
+
+class TrajectoryQueue:
+    """
+    Queue of trajectories between processes over a fixed pool of slots in shared memory.
+
+    Every slot holds one preallocated tensor per field (obs, actions, ...), allocated
+    once in shared memory. A producer takes a free slot with acquire(), writes the
+    trajectory in place and hands it over with commit(). A consumer takes the oldest
+    committed slot with get(), reads it and gives it back with release(). Only slot
+    indices and a small metadata dict go through the multiprocessing queues, the
+    frames are never pickled or copied by the transport.
+
+    The free slots are the backpressure: when the consumer holds or has not yet read
+    all of them, acquire() waits. The state of every slot (FREE, WRITING, READY,
+    READING) and the id of the producer that wrote it are kept in shared tensors,
+    every transition checks that the slot is in the expected state.
+
+    Args:
+        num_slots: number of trajectories that can be written or waiting at once
+        fields: dict name -> (shape, dtype) of the tensors of a trajectory
+        ctx: multiprocessing context of the processes that use the queue
+    """
+
+    def __init__(self, num_slots, fields, ctx=None):
+        ctx = ctx if ctx is not None else mp.get_context("spawn")
+        self.num_slots = num_slots
+        self.slots = {
+            name: torch.zeros((num_slots,) + tuple(shape), dtype=dtype).share_memory_()
+            for name, (shape, dtype) in fields.items()
+        }
+        self.state = torch.full((num_slots,), FREE, dtype=torch.int8).share_memory_()
+        self.owner = torch.full((num_slots,), -1, dtype=torch.int32).share_memory_()
+        self.free = ctx.Queue()
+        self.ready = ctx.Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+
+    def _transition(self, slot, expected, new):
+        if self.state[slot] != expected:
+            raise RuntimeError(f"Slot {slot} is in state {int(self.state[slot])}, expected {expected}")
+        self.state[slot] = new
+
+    def slot(self, slot):
+        """Returns the tensors of a slot, views into the shared memory."""
+        return {name: tensor[slot] for name, tensor in self.slots.items()}
+
+    def acquire(self, producer_id=0, timeout=None):
+        """Takes a free slot for writing, returns its index, or None if none was freed within timeout."""
+        try:
+            slot = self.free.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self._transition(slot, FREE, WRITING)
+        self.owner[slot] = producer_id
+        return slot
+
+    def commit(self, slot, metadata=None):
+        """Hands a written slot over to the consumers, metadata is a small picklable dict sent with it."""
+        self._transition(slot, WRITING, READY)
+        self.ready.put((slot, metadata if metadata is not None else {}))
+
+    def get(self, timeout=None):
+        """Takes the oldest committed slot for reading, returns (index, metadata)."""
+        slot, metadata = self.ready.get(timeout=timeout)
+        self._transition(slot, READY, READING)
+        return slot, metadata
+
+    def release(self, slot):
+        """Gives a slot that has been read back to the producers."""
+        self._transition(slot, READING, FREE)
+        self.owner[slot] = -1
+        self.free.put(slot)
+
+    def occupancy(self):
+        """Number of slots in each state."""
+        counts = torch.bincount(self.state.long(), minlength=4)
+        return {"free": int(counts[FREE]), "writing": int(counts[WRITING]), "ready": int(counts[READY]), "reading": int(counts[READING])}
+
+    def memory_footprint(self):
+        """Returns the shared memory used by the slots in MB."""
+        return sum(t.element_size() * t.nelement() for t in self.slots.values()) / 1024**2
@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+
+class HostToDevice:
+    """
+    Host to device copies of the arrays returned by envs.recv().
+
+    On CUDA every named array goes through pre-allocated pinned staging buffers
+    (num_slots per name, used round robin) and is copied with a non-blocking copy
+    on a dedicated stream, so the copies overlap with the policy forward pass.
+    Call wait() before the returned tensors are used on the compute stream.
+    On CPU-only hosts the arrays are wrapped with torch.from_numpy (zero-copy).
+
+    Args:
+        device: target device
+        num_slots: number of staging buffers per name
+    """
+
+    def __init__(self, device, num_slots=2):
+        self.device = torch.device(device)
+        self.use_pinned = self.device.type == "cuda"
+        self.num_slots = num_slots
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_pinned else None
+        self._staging = {}
+        self._events = {}
+        self._next_slot = {}
+
+    def copy(self, name, array):
+        """Starts the copy of a numpy array to the device and returns the device tensor."""
+        host = torch.from_numpy(np.asarray(array))
+        if not self.use_pinned:
+            return host
+
+        slot = self._next_slot.get(name, 0)
+        self._next_slot[name] = (slot + 1) % self.num_slots
+        key = (name, slot)
+
+        # Staging buffers only grow, partial batches use a view of the first elements
+        staging = self._staging.get(key)
+        if staging is None or staging.numel() < host.numel() or staging.dtype != host.dtype:
+            staging = torch.empty(host.numel(), dtype=host.dtype, pin_memory=True)
+            self._staging[key] = staging
+        elif key in self._events:
+            # The previous copy out of this staging buffer must be done before it is overwritten
+            self._events[key].synchronize()
+        staging = staging[:host.numel()].view(host.shape)
+        staging.copy_(host)
+
+        with torch.cuda.stream(self.stream):
+            out = staging.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self._events[key] = event
+        # The tensor was allocated on the copy stream but is consumed on the compute stream
+        out.record_stream(torch.cuda.current_stream(self.device))
+        return out
+
+    def wait(self):
+        """Makes the compute stream wait for the copies issued so far."""
+        if self.use_pinned:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)